@@ -1,7 +1,7 @@
 import traceback
-import multiprocessing
-import threading
+import queue
 import time
+from typing import Iterable, Union
 
 import boto3
 import pathlib
@@ -9,13 +9,22 @@ import pathlib
 import botocore.client
 import unicodedata
 
+import archive_index
+import async_core
+import bundles
+import catalog
+import compression
 import constants
 import commons
+import hashing
+import journal
+import metrics
+import progress
 
 archived_data_price_per_gb = 0.00099
 
 
-def process_archive_command(root: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str):
+def process_archive_command(root: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
     """
     Upload all files with the given prefix as glacier 'DEEP_ARCHIVE' objects. Confirmation is
     required: all info about the files will be listed.
@@ -23,6 +32,9 @@ def process_archive_command(root: pathlib.Path, aws_session: boto3.Session, user
     :param aws_session: AWS session with correct credentials that only allow the users prefix.
     :param user_id: ID of the user used as S3 prefix.
     :param command_data: Files will be archived under this relative path
+    :param flags: With "--pack", small files are packed into bundles instead of separate objects. With "--dedup",
+    files with identical content are uploaded only once. With "--compress", compressible files are compressed
+    while they are uploaded. With "--log=<file>", the outcome of every file is written into the file.
     """
     if command_data == 'root':
         absolute_path = root
@@ -31,78 +43,364 @@ def process_archive_command(root: pathlib.Path, aws_session: boto3.Session, user
 
     print(f'Files under "{absolute_path.as_posix()} will be archived."')
     print('Checking amount of files...')
-    files_data = commons.get_files_data(root, absolute_path)
-    print(f'Found a total of {files_data.file_count} files using {files_data.total_size_gb()} GB of space.')
-    print(f'Estimated cost for archiving these files is {round(files_data.total_size_gb() * archived_data_price_per_gb, 5)}$ per month. '
-          f'A one time upload cost will apply.')
-
-    proceed = input('Are you sure you want to proceed with archiving these files? (Y)')
-    if proceed == 'Y':
-        print(f'Starting the upload of the selected files using {constants.THREADS} parallel processes at {time.ctime()}')
-        with commons.catch_time() as archiving_timer:
-            __upload_files_to_archive(aws_session, user_id, files_data)
-        print(f'Complete! Archived {files_data.file_count} files in your deep archive! Finished at {time.ctime()} and took {archiving_timer():.4f} seconds')
+    archive_catalog = catalog.ArchiveCatalog(root)
+    try:
+        files_data = commons.FilesData(keep_files=False)
+        changed_files_data = __select_changed_files(archive_catalog, user_id, commons.scan_files(root, absolute_path), files_data)
+        print(f'Found a total of {files_data.file_count} files using {files_data.total_size_gb()} GB of space.')
+        if changed_files_data.file_count == 0:
+            print('All of these files are already archived and have not changed since, there is nothing to upload.')
+            return
+        print(f'{changed_files_data.file_count} of these files are new or modified since they were last archived, '
+              f'using {changed_files_data.total_size_gb()} GB of space.')
+        print(f'Estimated cost for archiving these files is {round(changed_files_data.total_size_gb() * archived_data_price_per_gb, 5)}$ per month. '
+              f'A one time upload cost will apply.')
+
+        proceed = input('Are you sure you want to proceed with archiving these files? (Y)')
+        if proceed == 'Y':
+            print(f'Starting the upload of the selected files with up to {constants.UPLOAD_MAX_CONCURRENCY} uploads in flight at {time.ctime()}')
+            with commons.catch_time() as archiving_timer:
+                __upload_files_to_archive(aws_session, user_id, __key_prefix_of(root, absolute_path, user_id), changed_files_data,
+                                          archive_catalog, 'pack' in flags, 'dedup' in flags, 'compress' in flags, flags.get('log'))
+            print(f'Complete! Archived {changed_files_data.file_count} files in your deep archive! Finished at {time.ctime()} and took {archiving_timer():.4f} seconds')
+        else:
+            print('Aborting the archive command...')
+    finally:
+        archive_catalog.close()
+
+
+def __select_changed_files(
+        archive_catalog: catalog.ArchiveCatalog,
+        user_id: str,
+        files: Iterable[commons.FileRecord],
+        files_data: commons.FilesData
+) -> commons.FilesData:
+    """
+    Compare the found files with the catalog, and keep only the ones that were never archived or
+    changed since their last upload. Files that were only touched (same size and content) are
+    not uploaded again, but their catalog entry is refreshed.
+    :param files_data: Every found file is registered here, changed or not.
+    """
+    changed_files_data = commons.FilesData()
+    for file in files:
+        files_data.register_file(file)
+        entry = archive_catalog.lookup(__create_object_key(user_id, file.path_relative))
+        if entry is not None and entry.size == file.size:
+            if entry.mtime_ns == file.mtime_ns:
+                continue
+            # entries archived before the tree hash keep their plain SHA-256 until the file changes
+            content_hash = hashing.hash_file_like(file.path_absolute, entry.content_hash)
+            if content_hash == entry.content_hash:
+                archive_catalog.record(entry.key, file.size, file.mtime_ns, content_hash)
+                continue
+        changed_files_data.register_file(file)
+    return changed_files_data
+
+
+def __upload_files_to_archive(
+        aws_session: boto3.Session,
+        user_id: str,
+        key_prefix: str,
+        data: commons.FilesData,
+        archive_catalog: catalog.ArchiveCatalog,
+        pack: bool,
+        dedup: bool,
+        compress: bool,
+        log_path: Union[str, None]
+):
+    # largest files first: this way the big uploads don't end up in the tail of the run
+    bundle_queue = queue.Queue()
+    bundled_size = 0
+    other_files = []
+    for file in sorted(data.files, key=lambda f: f.size, reverse=True):
+        if pack and file.size < constants.PACK_FILE_SIZE_THRESHOLD:
+            bundle_queue.put(file)
+            bundled_size += file.size
+        else:
+            other_files.append(file)
+
+    s3_client = commons.build_s3_client(aws_session)
+    if dedup:
+        upload_tasks, deduplicated_files = __deduplicate_files(s3_client, user_id, other_files, archive_catalog)
     else:
-        print('Aborting the archive command...')
+        upload_tasks = [(file, __create_object_key(user_id, file.path_relative), None) for file in other_files]
+        deduplicated_files = dict()
+    __abort_stale_uploads(s3_client, archive_catalog.journal, key_prefix, {key for _, key, _ in upload_tasks})
+
+    total_count = len(upload_tasks) + bundle_queue.qsize()
+    total_size = sum(file.size for file, _, _ in upload_tasks) + bundled_size
+
+    transfer_engine = commons.TransferEngine()
+    thread_pool = metrics.run_thread_pool(constants.THREADS)
+    upload_client = commons.build_s3_client_accelerated(aws_session)
+    concurrency = async_core.AdaptiveConcurrency('uploads', constants.UPLOAD_INITIAL_CONCURRENCY, constants.UPLOAD_MAX_CONCURRENCY,
+                                                 watch_latency=False)
+    with progress.Progress('Archiving', total_count, total_size, log_path) as archive_progress:
+        if bundle_queue.qsize() > 0:
+            bundle_workers = min(constants.THREADS, -(-bundled_size // constants.BUNDLE_TARGET_SIZE))
+            archive_progress.print(f'{bundle_queue.qsize()} small files will be packed into bundles using {bundle_workers} parallel processes.')
+            for _ in range(max(1, bundle_workers)):
+                thread_pool.apply_async(__bundle_worker,
+                                        (aws_session, bundle_queue, user_id, archive_progress, archive_catalog, transfer_engine))
+        thread_pool.close()
+
+        # the bundles are built in the background, while the other files are uploaded on a shared client
+        with concurrency.watching(upload_client):
+            async_core.run_bounded(upload_tasks, __upload_file_to_archive,
+                                   (upload_client, archive_progress, archive_catalog, transfer_engine, compress),
+                                   concurrency, units=lambda upload_task: upload_task[0].size / (1024*1024))
+        thread_pool.join()
+    concurrency.print_summary('MB/s')
 
+    if dedup:
+        __save_deduplicated_files(s3_client, user_id, deduplicated_files, archive_catalog)
 
-progress_count = 0
 
+def __abort_stale_uploads(s3_client, archive_journal: journal.ArchiveJournal, key_prefix: str, upload_keys: set[str]):
+    """
+    Abort the uploads of the journal that will not be continued: bundles (they are streamed, and can't be continued),
+    uploads of files under the archived folder that no longer need to be uploaded, and uploads that were left alone for too long.
+    """
+    for upload in archive_journal.in_flight_uploads():
+        if (not upload.is_resumable() or upload.started_at < time.time() - constants.MULTIPART_UPLOAD_MAX_AGE_SECONDS
+                or (upload.key.startswith(key_prefix) and upload.key not in upload_keys)):
+            try:
+                commons.abort_multipart_upload(s3_client, archive_journal, upload)
+                print(f'Aborted the unfinished upload of "{upload.key}" from an earlier run.')
+            except botocore.client.ClientError as e:
+                print(f'Failed to abort the unfinished upload of "{upload.key}": {e.response["Error"]["Code"]}')
 
-def __upload_files_to_archive(aws_session: boto3.Session, user_id: str, data: commons.FilesData):
-    global progress_count
-    progress_count = 0
 
-    lock = threading.Lock()
-    thread_pool = multiprocessing.pool.ThreadPool(processes=constants.THREADS)
-    for batched_files in commons.batch(data.files, constants.THREADS):
-        # separate thread for the batched files
-        thread_pool.apply_async(__upload_batch_to_archive,
-                                (aws_session, batched_files, user_id, lock, data.file_count))
+def __deduplicate_files(
+        s3_client,
+        user_id: str,
+        files: list[commons.FileRecord],
+        archive_catalog: catalog.ArchiveCatalog
+) -> tuple[list, dict]:
+    """
+    Hash the files in parallel and group the ones with identical content. Only one file of each group is
+    uploaded, under a key derived from its content, and only if that content is not yet in the archive.
+    :return: The upload tasks, and the groups of files with their content hash, by the content key.
+    """
+    print(f'Calculating the content hash of {len(files)} files to find duplicates...')
+    thread_pool = metrics.run_thread_pool(constants.THREADS)
+    content_hashes = thread_pool.map(__hash_file_if_readable, [file.path_absolute for file in files])
     thread_pool.close()
     thread_pool.join()
 
+    deduplicated_files = dict()
+    for file, content_hash in zip(files, content_hashes):
+        if content_hash is None:
+            print(f'Failed to read the file with key {__sanitize_prefix(file.path_relative)}, it will not be archived!')
+            continue
+        blob_key = f'{user_id}/{constants.BLOB_FOLDER}{content_hash}'
+        deduplicated_files.setdefault(blob_key, (content_hash, []))[1].append(file)
+
+    upload_tasks = []
+    for blob_key, (content_hash, group) in deduplicated_files.items():
+        if archive_catalog.lookup(blob_key) is not None:
+            continue
+        if __object_exists(s3_client, blob_key):
+            # archived from another machine, remember it so the next run does not have to check
+            archive_catalog.record(blob_key, group[0].size, group[0].mtime_ns, content_hash)
+            continue
+        upload_tasks.append((group[0], blob_key, content_hash))
+
+    unique_size = sum(file.size for file, _, _ in upload_tasks)
+    print(f'{len(files) - len(upload_tasks)} files are duplicates or their content is already archived. '
+          f'{len(upload_tasks)} files with unique content will be uploaded, using {round(unique_size / (1024*1024*1024), 3)} GB of space.')
+    return upload_tasks, deduplicated_files
+
+
+def __hash_file_if_readable(path: str) -> Union[str, None]:
+    try:
+        return hashing.hash_file(path)
+    except OSError:
+        return None
+
+
+def __object_exists(s3_client, key: str) -> bool:
+    try:
+        s3_client.head_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+        return True
+    except botocore.client.ClientError as e:
+        # other errors (access denied, throttling) must not make the content look missing, it would be uploaded again
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def __save_deduplicated_files(s3_client, user_id: str, deduplicated_files: dict, archive_catalog: catalog.ArchiveCatalog):
+    """
+    Write the index that points every deduplicated file to its content. Files are added to the catalog
+    only after that, otherwise a failed run could leave them out of the index forever.
+    """
+    entries = []
+    archived_files = []
+    for blob_key, (content_hash, group) in deduplicated_files.items():
+        if archive_catalog.lookup(blob_key) is None:
+            # the content failed to upload
+            continue
+        for file in group:
+            entries.append(archive_index.IndexEntry(__sanitize_prefix(file.path_relative), blob_key, None, file.size, content_hash))
+            archived_files.append((file, content_hash))
+
+    try:
+        for start in range(0, len(entries), constants.INDEX_MAX_ENTRIES):
+            archive_index.upload_index(s3_client, user_id, entries[start:start + constants.INDEX_MAX_ENTRIES])
+    except botocore.client.ClientError as e:
+        print(f'Failed to save the index of the deduplicated files: {e.response["Error"]["Code"]}! Run the archive command again.')
+        traceback.print_exc()
+        return
+
+    for file, content_hash in archived_files:
+        archive_catalog.record(__create_object_key(user_id, file.path_relative), file.size, file.mtime_ns, content_hash)
+
 
-def __upload_batch_to_archive(
+def __bundle_worker(
         aws_session: boto3.Session,
-        batched_files,
+        bundle_queue: queue.Queue,
         user_id: str,
-        lock: threading.Lock,
-        total_count: int
+        archive_progress: progress.Progress,
+        archive_catalog: catalog.ArchiveCatalog,
+        transfer_engine: commons.TransferEngine
 ):
+    """
+    Long living worker: packs files from the shared queue into bundles until it is empty.
+    """
     s3_client = commons.build_s3_client_accelerated(aws_session)
-    for file in batched_files:
-        __upload_file_to_archive(s3_client, file, user_id, lock, total_count)
+    while not bundle_queue.empty():
+        __upload_bundle_to_archive(s3_client, bundle_queue, user_id, archive_progress, archive_catalog, transfer_engine)
+
+
+def __upload_bundle_to_archive(
+        s3_client,
+        bundle_queue: queue.Queue,
+        user_id: str,
+        archive_progress: progress.Progress,
+        archive_catalog: catalog.ArchiveCatalog,
+        transfer_engine: commons.TransferEngine
+):
+    """
+    Stream files from the queue into one bundle, until it reaches the target size. The location of the
+    files is saved into an index object, and they are added to the catalog once the bundle is complete.
+    """
+    part_size = transfer_engine.select_part_size(constants.BUNDLE_TARGET_SIZE)
+    packed_files = []
+    with transfer_engine.budget.reserve(part_size):
+        bundle = bundles.BundleWriter(s3_client, user_id, part_size, transfer_engine.bandwidth, archive_catalog.journal)
+        try:
+            while bundle.size() < constants.BUNDLE_TARGET_SIZE:
+                try:
+                    file = bundle_queue.get_nowait()
+                except queue.Empty:
+                    break
+                sanitized_prefix = __sanitize_prefix(file.path_relative)
+                try:
+                    with open(file.path_absolute, 'rb') as file_handle:
+                        content = file_handle.read()
+                except OSError as e:
+                    archive_progress.failed(sanitized_prefix, f'failed to read the file: {e}', file.size)
+                    continue
+                content_hash = hashing.hash_content(content)
+                bundle.add(sanitized_prefix, content, file.mtime_ns / 1_000_000_000, content_hash)
+                packed_files.append((file, content_hash))
 
+            if len(packed_files) == 0:
+                bundle.abort()
+                return
+            bundle.finish()
+            archive_index.upload_index(s3_client, user_id, bundle.entries)
+        except botocore.client.ClientError as e:
+            # the files only count as archived once their bundle is complete
+            for file, _ in packed_files:
+                archive_progress.failed(__sanitize_prefix(file.path_relative), f'failed to upload its bundle: {e.response["Error"]["Code"]}',
+                                        file.size, with_traceback=True)
+            bundle.abort()
+            return
 
-def __upload_file_to_archive(s3_client, file, user_id: str, lock: threading.Lock, total_count: int):
-    progress_percent = __update_progress(lock, total_count)
-    sanitized_prefix = __sanitize_prefix(file["path_relative"])
-    key = f'{user_id}/{sanitized_prefix}'
+    for file, content_hash in packed_files:
+        archive_catalog.record(__create_object_key(user_id, file.path_relative), file.size, file.mtime_ns, content_hash)
+        archive_progress.completed(__sanitize_prefix(file.path_relative), file.size, f'packed into the bundle {bundle.bundle_key}')
+
+
+def __upload_file_to_archive(
+        upload_task: tuple[commons.FileRecord, str, Union[str, None]],
+        s3_client,
+        archive_progress: progress.Progress,
+        archive_catalog: catalog.ArchiveCatalog,
+        transfer_engine: commons.TransferEngine,
+        compress: bool
+):
+    file, key, content_hash = upload_task
+    sanitized_prefix = __sanitize_prefix(file.path_relative)
     try:
-        s3_client.upload_file(
-            Filename=file['path_absolute'],
-            Bucket=constants.ARCHIVE_BUCKET_NAME,
-            Key=key,
-            ExtraArgs={
-                'StorageClass': constants.S3_DEEP_ARCHIVE
-            }
-        )
-        print(f'Uploaded file with key {sanitized_prefix} to archive. Archiving {progress_percent}% complete.')
+        # hashed before the upload, so the catalog never claims content that was not sent
+        if content_hash is None:
+            content_hash = hashing.hash_file(file.path_absolute)
+        if not (compress and compression.is_compressible(file.path_absolute, file.size)
+                and __upload_compressed(s3_client, file, key, content_hash, transfer_engine)):
+            transfer_engine.upload_file(
+                s3_client,
+                filename=file.path_absolute,
+                size=file.size,
+                key=key,
+                extra_args={
+                    'StorageClass': constants.S3_DEEP_ARCHIVE,
+                    'Metadata': {
+                        hashing.CONTENT_HASH_METADATA_KEY: content_hash
+                    }
+                },
+                archive_journal=archive_catalog.journal,
+                content_hash=content_hash
+            )
+        archive_catalog.record(key, file.size, file.mtime_ns, content_hash)
+        archive_progress.completed(sanitized_prefix, file.size, 'uploaded')
     except botocore.client.ClientError as e:
-        print(f'Failed to upload the file with key {sanitized_prefix} to the archive: {e.response["Error"]["Code"]}! Archiving {progress_percent}% complete.')
-        traceback.print_exc()
+        archive_progress.failed(sanitized_prefix, f'failed to upload: {e.response["Error"]["Code"]}', file.size, with_traceback=True)
+    except OSError as e:
+        # a failing file must not stop the worker, it has more files to upload
+        archive_progress.failed(sanitized_prefix, f'failed to read the file: {e}', file.size)
 
 
-def __sanitize_prefix(prefix: str):
-    prefix = prefix.replace(' ', '')
-    return unicodedata.normalize('NFKD', prefix)
+def __upload_compressed(s3_client, file: commons.FileRecord, key: str, content_hash: str, transfer_engine: commons.TransferEngine) -> bool:
+    """
+    Upload the compressed content of the file. Objects are stored compressed only if they become smaller, the
+    download command relies on this to skip existing files by their size.
+    :return: False if the compressed content was not smaller, then nothing was uploaded.
+    """
+    try:
+        with open(file.path_absolute, 'rb') as file_handle:
+            transfer_engine.upload_fileobj(
+                s3_client,
+                fileobj=compression.CompressingReader(file_handle, compression.DEFAULT_CODEC, file.size),
+                size=file.size,
+                key=key,
+                extra_args={
+                    'StorageClass': constants.S3_DEEP_ARCHIVE,
+                    'Metadata': {
+                        compression.CODEC_METADATA_KEY: compression.DEFAULT_CODEC,
+                        compression.ORIGINAL_SIZE_METADATA_KEY: str(file.size),
+                        hashing.CONTENT_HASH_METADATA_KEY: content_hash
+                    }
+                }
+            )
+        return True
+    except compression.NotSmallerError:
+        return False
+
+
+def __key_prefix_of(root: pathlib.Path, absolute_path: pathlib.Path, user_id: str) -> str:
+    if absolute_path == root:
+        return f'{user_id}/'
+    return __create_object_key(user_id, absolute_path.relative_to(root).as_posix()) + '/'
 
 
-def __update_progress(lock: threading.Lock, total_count: int) -> float:
-    global progress_count
+def __create_object_key(user_id: str, path_relative: str) -> str:
+    return f'{user_id}/{__sanitize_prefix(path_relative)}'
 
-    with lock:
-        progress_count += 1
 
-    return round((progress_count/total_count)*100, 3)
+def __sanitize_prefix(prefix: str):
+    prefix = prefix.replace(' ', '')
+    return unicodedata.normalize('NFKD', prefix)
+
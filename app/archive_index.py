@@ -0,0 +1,113 @@
+import datetime
+import json
+import uuid
+from typing import Union
+
+import constants
+import metrics
+
+
+class IndexEntry:
+    """
+    Location of an archived file that is not stored as its own object: it is found in the
+    object at the given offset. An offset of None means that the whole object is the file.
+    """
+    __slots__ = ('key', 'object_key', 'offset', 'size', 'content_hash', 'last_modified')
+
+    def __init__(self, key: str, object_key: str, offset: Union[int, None], size: int, content_hash: Union[str, None] = None,
+                 last_modified: datetime.datetime = None):
+        """
+        :param key: Key of the file, relative to the user prefix.
+        :param object_key: Full key of the object that stores the file.
+        :param content_hash: Hash of the file's content, None for entries saved before the hash was indexed.
+        """
+        self.key = key
+        self.object_key = object_key
+        self.offset = offset
+        self.size = size
+        self.content_hash = content_hash
+        self.last_modified = last_modified
+
+
+class ArchiveIndex:
+    """
+    Every index entry of a user, loaded from the index objects. If a key appears more than
+    once, the most recent entry is used.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, IndexEntry] = dict()
+
+    def add(self, entry: IndexEntry):
+        existing_entry = self.entries.get(entry.key)
+        if existing_entry is None or existing_entry.last_modified <= entry.last_modified:
+            self.entries[entry.key] = entry
+
+    def entries_with_prefix(self, relative_prefix: str) -> list[IndexEntry]:
+        return [entry for key, entry in self.entries.items() if key.startswith(relative_prefix)]
+
+    def keep_plain_object(self, key: str, last_modified: datetime.datetime) -> bool:
+        """
+        Decide between a regular object and an index entry with the same key: the one archived
+        later wins. If the regular object wins, the index entry is dropped.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return True
+        if entry.last_modified >= last_modified:
+            return False
+        del self.entries[key]
+        return True
+
+
+def load_archive_index(s3_client, user_id: str) -> ArchiveIndex:
+    """
+    Download and merge all index objects of the user. They are stored in the STANDARD
+    storage class, so no restoration is needed to read them.
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(
+        Bucket=constants.ARCHIVE_BUCKET_NAME,
+        Prefix=f'{user_id}/{constants.INDEX_FOLDER}'
+    )
+    index_objects = []
+    for page in pages:
+        for s3_object in page.get('Contents', []):
+            index_objects.append((s3_object['Key'], s3_object['LastModified']))
+
+    archive_index = ArchiveIndex()
+    if len(index_objects) == 0:
+        return archive_index
+
+    thread_pool = metrics.run_thread_pool(constants.THREADS)
+    index_contents = thread_pool.starmap(__read_index_object, [(s3_client, key) for key, _ in index_objects])
+    thread_pool.close()
+    thread_pool.join()
+
+    for (_, last_modified), content in zip(index_objects, index_contents):
+        for key, object_key, offset, size, *content_hash in content['entries']:
+            # older index objects have no content hash
+            archive_index.add(IndexEntry(key, f'{user_id}/{object_key}', offset, size, next(iter(content_hash), None), last_modified))
+    return archive_index
+
+
+def __read_index_object(s3_client, key: str) -> dict:
+    response = s3_client.get_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+    return json.loads(response['Body'].read())
+
+
+def upload_index(s3_client, user_id: str, entries: list[IndexEntry]):
+    """
+    Save new index entries as a separate index object.
+    """
+    content = {
+        'entries': [
+            [entry.key, entry.object_key.removeprefix(f'{user_id}/'), entry.offset, entry.size, entry.content_hash] for entry in entries
+        ]
+    }
+    s3_client.put_object(
+        Bucket=constants.ARCHIVE_BUCKET_NAME,
+        Key=f'{user_id}/{constants.INDEX_FOLDER}{uuid.uuid4().hex}.json',
+        Body=json.dumps(content).encode('utf-8'),
+        StorageClass=constants.S3_STANDARD
+    )
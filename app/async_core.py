@@ -0,0 +1,177 @@
+import asyncio
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Iterable, Union
+
+import constants
+import metrics
+
+
+class ConcurrencyChange:
+
+    def __init__(self, at: float, old_limit: int, new_limit: int, reason: str):
+        self.at = at
+        self.old_limit = old_limit
+        self.new_limit = new_limit
+        self.reason = reason
+
+
+class AdaptiveConcurrency:
+    """
+    Chooses how many operations may be in flight, in AIMD style: the limit is raised by a fixed step while the
+    throughput keeps improving, and cut by a factor when S3 throttles the requests or the latency rises.
+    Decisions are made once per time window, at the first completed operation after it ends.
+    """
+
+    def __init__(self, name: str, initial: int, maximum: int, minimum: int = constants.ADAPTIVE_MIN_CONCURRENCY,
+                 watch_latency: bool = True):
+        """
+        :param watch_latency: Lower the limit when the latency rises. Only meaningful if the operations are similar,
+        the latency of transfers depends on the size of the objects more than on the load.
+        """
+        self.name = name
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = initial
+        self.peak_limit = initial
+        self.changes: list[ConcurrencyChange] = []
+        self.watch_latency = watch_latency
+        self.__increase_step = max(1, initial // 2)
+        self.__lock = threading.Lock()
+        self.__active = 0
+        self.__window_start = time.monotonic()
+        self.__window_operations = 0
+        self.__window_units = 0
+        self.__window_latency = 0.0
+        self.__window_peak_active = 0
+        self.__window_throttles = 0
+        self.__last_throughput = None
+        self.__baseline_latency = None
+
+    @contextmanager
+    def watching(self, s3_client):
+        """
+        Count the throttled responses of the client while in this context. These are retried by botocore, so the
+        operations would not see them. The client is shared, so the hook is removed at the end.
+        """
+        s3_client.meta.events.register_first('needs-retry.s3', self.__on_needs_retry)
+        try:
+            yield self
+        finally:
+            s3_client.meta.events.unregister('needs-retry.s3', self.__on_needs_retry)
+
+    def run(self, operation: Callable, item, args: tuple, units: int):
+        with self.__lock:
+            self.__active += 1
+            self.__window_peak_active = max(self.__window_peak_active, self.__active)
+            active = self.__active
+        metrics.sample('in_flight', active, self.name)
+        metrics.sample('concurrency_limit', self.limit, self.name)
+        start = time.perf_counter()
+        try:
+            return operation(item, *args)
+        finally:
+            latency = time.perf_counter() - start
+            metrics.observe('operation_seconds', latency, self.name)
+            metrics.count('operation_units', units, self.name)
+            with self.__lock:
+                self.__active -= 1
+                self.__window_operations += 1
+                self.__window_units += units
+                self.__window_latency += latency
+                self.__adjust()
+
+    def print_summary(self, unit: str):
+        print(f'Concurrency of {self.name}: started at {self.initial}, finished at {self.limit}, highest was {self.peak_limit}.')
+        for change in self.changes[-constants.ADAPTIVE_REPORTED_CHANGES:]:
+            print(f'  {time.strftime("%H:%M:%S", time.localtime(change.at))} {change.old_limit} -> {change.new_limit}: {change.reason.format(unit=unit)}')
+        if len(self.changes) > constants.ADAPTIVE_REPORTED_CHANGES:
+            print(f'  ({len(self.changes) - constants.ADAPTIVE_REPORTED_CHANGES} earlier changes are not shown)')
+
+    def __on_needs_retry(self, response=None, **kwargs):
+        if response is None:
+            return None
+        http_response, parsed_response = response
+        error_code = parsed_response.get('Error', {}).get('Code')
+        if error_code in constants.S3_THROTTLING_ERROR_CODES or http_response.status_code == 503:
+            with self.__lock:
+                self.__window_throttles += 1
+        return None
+
+    def __adjust(self):
+        elapsed = time.monotonic() - self.__window_start
+        if elapsed < constants.ADAPTIVE_WINDOW_SECONDS:
+            return
+        throughput = self.__window_units / elapsed
+        latency = self.__window_latency / self.__window_operations
+        saturated = self.__window_peak_active >= self.limit
+
+        if self.__window_throttles > 0:
+            self.__change(int(self.limit * constants.ADAPTIVE_DECREASE_FACTOR), f'S3 throttled {self.__window_throttles} requests')
+        elif self.watch_latency and self.__baseline_latency is not None and latency > self.__baseline_latency * constants.ADAPTIVE_LATENCY_FACTOR \
+                and not self.__improved(throughput):
+            self.__change(int(self.limit * constants.ADAPTIVE_DECREASE_FACTOR),
+                          f'latency rose from {self.__baseline_latency * 1000:.0f} ms to {latency * 1000:.0f} ms')
+        elif saturated and (self.__last_throughput is None or self.__improved(throughput)):
+            previous = '' if self.__last_throughput is None else f' from {self.__last_throughput:.1f}'
+            self.__change(self.limit + self.__increase_step, f'throughput improved{previous} to {throughput:.1f} {{unit}}')
+
+        if self.__baseline_latency is None or latency < self.__baseline_latency:
+            self.__baseline_latency = latency
+        self.__last_throughput = throughput
+        self.__window_start = time.monotonic()
+        self.__window_operations = 0
+        self.__window_units = 0
+        self.__window_latency = 0.0
+        self.__window_peak_active = self.__active
+        self.__window_throttles = 0
+
+    def __improved(self, throughput: float) -> bool:
+        return throughput > self.__last_throughput * constants.ADAPTIVE_IMPROVEMENT_FACTOR
+
+    def __change(self, new_limit: int, reason: str):
+        new_limit = min(self.maximum, max(self.minimum, new_limit))
+        if new_limit == self.limit:
+            return
+        self.changes.append(ConcurrencyChange(time.time(), self.limit, new_limit, reason))
+        self.limit = new_limit
+        self.peak_limit = max(self.peak_limit, new_limit)
+
+
+def run_bounded(items: Iterable, operation: Callable, args: tuple, concurrency: AdaptiveConcurrency, units: Union[Callable, None] = None):
+    """
+    Call operation(item, *args) for every item, with at most as many calls in flight as the concurrency controller
+    allows. The event loop pulls the items lazily, so they can be streamed without reading all of them into memory.
+    boto3 only has a blocking API, so every call is run in a worker thread, and the clients passed in the args are
+    shared by all of them. Errors are expected to be handled by the operation, unexpected ones are printed and do
+    not stop the others.
+    :param units: Size of the work of an item, such as its bytes, used to measure the throughput. One per item by default.
+    """
+    asyncio.run(__run_bounded(items, operation, args, concurrency, units))
+
+
+async def __run_bounded(items: Iterable, operation: Callable, args: tuple, concurrency: AdaptiveConcurrency, units: Union[Callable, None]):
+    loop = asyncio.get_running_loop()
+    slot_freed = asyncio.Event()
+    pending = set()
+
+    def on_done(future: asyncio.Future):
+        pending.discard(future)
+        slot_freed.set()
+        if not future.cancelled() and future.exception() is not None:
+            traceback.print_exception(future.exception())
+
+    with metrics.RunThreadPoolExecutor(max_workers=concurrency.maximum) as executor:
+        for item in items:
+            # the limit may change while operations are running, so it is checked again after every completion
+            while len(pending) >= concurrency.limit:
+                slot_freed.clear()
+                await slot_freed.wait()
+            future = loop.run_in_executor(executor, concurrency.run, operation, item, args, 1 if units is None else units(item))
+            pending.add(future)
+            future.add_done_callback(on_done)
+        if len(pending) > 0:
+            await asyncio.wait(set(pending))
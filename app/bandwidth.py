@@ -0,0 +1,110 @@
+import datetime
+import json
+import os.path as path
+import threading
+import time
+from typing import Union
+
+import metrics
+
+
+class BandwidthWindow:
+
+    def __init__(self, start: datetime.time, end: datetime.time, bytes_per_second: Union[int, None]):
+        self.start = start
+        self.end = end
+        self.bytes_per_second = bytes_per_second
+
+    def contains(self, moment: datetime.time) -> bool:
+        if self.start <= self.end:
+            return self.start <= moment < self.end
+        # the window goes past midnight
+        return moment >= self.start or moment < self.end
+
+
+class BandwidthSchedule:
+    """
+    Bandwidth limit depending on the time of the day. The first window that contains the current time
+    applies, outside the windows the default limit does. A limit of None means unlimited, a limit of 0 pauses the transfers.
+    """
+
+    def __init__(self, default_bytes_per_second: Union[int, None] = None, windows: list[BandwidthWindow] = None):
+        self.default_bytes_per_second = default_bytes_per_second
+        self.windows = windows if windows is not None else []
+
+    def limit_at(self, moment: datetime.datetime) -> Union[int, None]:
+        for window in self.windows:
+            if window.contains(moment.time()):
+                return window.bytes_per_second
+        return self.default_bytes_per_second
+
+    def is_unlimited(self) -> bool:
+        return self.default_bytes_per_second is None and all(window.bytes_per_second is None for window in self.windows)
+
+
+class BandwidthLimiter:
+    """
+    Token bucket shared by all transfers. Every transferred chunk takes tokens from the bucket, which is refilled
+    at the rate allowed by the schedule. The bucket may go into debt with a large chunk, then the following
+    transfers wait until it is paid back.
+    """
+
+    def __init__(self, schedule: BandwidthSchedule):
+        self.schedule = schedule
+        self.__lock = threading.Lock()
+        self.__tokens = 0.0
+        self.__last_refill = time.monotonic()
+
+    def consume(self, amount: int):
+        # every transferred chunk passes through here, limited or not
+        metrics.count('transferred_bytes', amount)
+        if amount <= 0 or self.schedule.is_unlimited():
+            return
+        while True:
+            with self.__lock:
+                rate = self.schedule.limit_at(datetime.datetime.now())
+                now = time.monotonic()
+                if rate is None:
+                    self.__tokens = 0.0
+                    self.__last_refill = now
+                    return
+                if rate == 0:
+                    # paused until the schedule allows transfers again
+                    self.__tokens = 0.0
+                    self.__last_refill = now
+                    wait_time = 1.0
+                else:
+                    # at most one second worth of tokens can be saved up, so bursts stay short
+                    self.__tokens = min(float(rate), self.__tokens + (now - self.__last_refill) * rate)
+                    self.__last_refill = now
+                    if self.__tokens >= 0:
+                        self.__tokens -= amount
+                        return
+                    wait_time = -self.__tokens / rate
+            # waiting in short steps, so that a change of the schedule takes effect soon
+            time.sleep(min(wait_time, 1.0))
+            metrics.count('bandwidth_wait_seconds', min(wait_time, 1.0))
+
+
+def load_bandwidth_schedule(file_name: str) -> BandwidthSchedule:
+    """
+    Read the schedule from a JSON file, if it exists. For example, unlimited at night and 20 Mbit/s during work hours:
+    {"default_bytes_per_second": null, "windows": [{"start": "08:00", "end": "18:00", "bytes_per_second": 2500000}]}
+    """
+    if not path.isfile(file_name):
+        return BandwidthSchedule()
+    with open(file_name, 'r') as schedule_file:
+        schedule_data = json.load(schedule_file)
+    windows = [
+        BandwidthWindow(
+            datetime.time.fromisoformat(window['start']),
+            datetime.time.fromisoformat(window['end']),
+            window.get('bytes_per_second')
+        )
+        for window in schedule_data.get('windows', [])
+    ]
+    schedule = BandwidthSchedule(schedule_data.get('default_bytes_per_second'), windows)
+    limits = [schedule.default_bytes_per_second] + [window.bytes_per_second for window in windows]
+    if any(limit is not None and limit < 0 for limit in limits):
+        raise Exception(f'The bandwidth limits in "{file_name}" can not be negative!')
+    return schedule
@@ -0,0 +1,132 @@
+import io
+import tarfile
+import uuid
+
+import archive_index
+import bandwidth
+import constants
+import journal
+
+
+class MultipartUploadWriter:
+    """
+    Write only file object that streams the written data into a multipart upload. At most one
+    part is kept in memory, nothing is staged on the disk. The upload is recorded in the journal,
+    if given, so that it can be aborted later if the program is killed before it is completed.
+    """
+
+    def __init__(self, s3_client, key: str, part_size: int, extra_args: dict, bandwidth_limiter: bandwidth.BandwidthLimiter = None,
+                 archive_journal: journal.ArchiveJournal = None):
+        self.key = key
+        self.part_size = part_size
+        self.__bandwidth_limiter = bandwidth_limiter
+        self.__archive_journal = archive_journal
+        self.__s3_client = s3_client
+        self.__extra_args = extra_args
+        self.__buffer = bytearray()
+        self.__upload_id = None
+        self.__parts = []
+
+    def write(self, data) -> int:
+        self.__buffer += data
+        while len(self.__buffer) >= self.part_size:
+            self.__upload_part(bytes(self.__buffer[:self.part_size]))
+            del self.__buffer[:self.part_size]
+        return len(data)
+
+    def complete(self):
+        if self.__upload_id is None:
+            # everything fit into one part, no need for a multipart upload
+            self.__consume_bandwidth(len(self.__buffer))
+            self.__s3_client.put_object(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=self.key,
+                Body=bytes(self.__buffer),
+                **self.__extra_args
+            )
+        else:
+            if len(self.__buffer) > 0:
+                self.__upload_part(bytes(self.__buffer))
+            self.__s3_client.complete_multipart_upload(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=self.key,
+                UploadId=self.__upload_id,
+                MultipartUpload={'Parts': self.__parts}
+            )
+            self.__record_upload_finished()
+        self.__buffer = bytearray()
+
+    def abort(self):
+        if self.__upload_id is not None:
+            self.__s3_client.abort_multipart_upload(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=self.key,
+                UploadId=self.__upload_id
+            )
+            self.__record_upload_finished()
+        self.__buffer = bytearray()
+
+    def __upload_part(self, data: bytes):
+        if self.__upload_id is None:
+            response = self.__s3_client.create_multipart_upload(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=self.key,
+                **self.__extra_args
+            )
+            self.__upload_id = response['UploadId']
+            if self.__archive_journal is not None:
+                self.__archive_journal.record_upload_started(self.key, self.__upload_id, self.part_size)
+        part_number = len(self.__parts) + 1
+        self.__consume_bandwidth(len(data))
+        response = self.__s3_client.upload_part(
+            Bucket=constants.ARCHIVE_BUCKET_NAME,
+            Key=self.key,
+            UploadId=self.__upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        self.__parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def __record_upload_finished(self):
+        if self.__archive_journal is not None:
+            self.__archive_journal.record_upload_finished(self.__upload_id)
+
+    def __consume_bandwidth(self, amount: int):
+        if self.__bandwidth_limiter is not None:
+            self.__bandwidth_limiter.consume(amount)
+
+
+class BundleWriter:
+    """
+    Packs small files into a tar archive that is streamed into a DEEP_ARCHIVE object. The
+    location of every packed file inside the bundle is collected as index entries, so
+    they can be extracted with ranged requests later.
+    """
+
+    def __init__(self, s3_client, user_id: str, part_size: int, bandwidth_limiter: bandwidth.BandwidthLimiter = None,
+                 archive_journal: journal.ArchiveJournal = None):
+        self.bundle_key = f'{user_id}/{constants.BUNDLE_FOLDER}{uuid.uuid4().hex}.tar'
+        self.entries: list[archive_index.IndexEntry] = []
+        self.__upload = MultipartUploadWriter(s3_client, self.bundle_key, part_size, {
+            'StorageClass': constants.S3_DEEP_ARCHIVE
+        }, bandwidth_limiter, archive_journal)
+        self.__tar = tarfile.open(fileobj=self.__upload, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def size(self) -> int:
+        return self.__tar.offset
+
+    def add(self, key: str, content: bytes, mtime: float, content_hash: str):
+        tar_info = tarfile.TarInfo(key)
+        tar_info.size = len(content)
+        tar_info.mtime = mtime
+        self.__tar.addfile(tar_info, io.BytesIO(content))
+        # the content is padded to full blocks, it ends where the tar archive currently is
+        padded_size = -(-len(content) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.entries.append(archive_index.IndexEntry(key, self.bundle_key, self.__tar.offset - padded_size, len(content), content_hash))
+
+    def finish(self):
+        self.__tar.close()
+        self.__upload.complete()
+
+    def abort(self):
+        self.__upload.abort()
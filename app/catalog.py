@@ -0,0 +1,84 @@
+import pathlib
+import sqlite3
+import threading
+import time
+from typing import Union
+
+import constants
+import journal
+
+
+class CatalogEntry:
+
+    def __init__(self, key: str, size: int, mtime_ns: int, content_hash: str):
+        self.key = key
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+
+
+class ArchiveCatalog:
+    """
+    Persistent, local record of every file that was uploaded to the archive. It is an SQLite
+    database placed inside the root folder, so that the archive command can skip files that
+    are already archived and have not changed since. Every record is also appended to the
+    journal, which keeps the records of the batch that was not committed if the program is killed.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.path = root.joinpath(constants.CATALOG_FILE_NAME)
+        self.__lock = threading.Lock()
+        self.__pending_writes = 0
+        self.__connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.__lock:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS archived_files ('
+                'key TEXT PRIMARY KEY, '
+                'size INTEGER NOT NULL, '
+                'mtime_ns INTEGER NOT NULL, '
+                'content_hash TEXT NOT NULL, '
+                'archived_at REAL NOT NULL)'
+            )
+            self.__connection.commit()
+        self.journal = journal.ArchiveJournal(root)
+        with self.__lock:
+            for key, size, mtime_ns, content_hash in self.journal.completed_files:
+                self.__insert(key, size, mtime_ns, content_hash)
+            self.__connection.commit()
+
+    def lookup(self, key: str) -> Union[CatalogEntry, None]:
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT key, size, mtime_ns, content_hash FROM archived_files WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return CatalogEntry(*row)
+
+    def record(self, key: str, size: int, mtime_ns: int, content_hash: str):
+        """
+        Save (or overwrite) the entry of an archived file. Writes are committed in batches,
+        call close to make sure everything is persisted.
+        """
+        self.journal.record_file(key, size, mtime_ns, content_hash)
+        with self.__lock:
+            self.__insert(key, size, mtime_ns, content_hash)
+            self.__pending_writes += 1
+            if self.__pending_writes >= constants.CATALOG_COMMIT_INTERVAL:
+                self.__connection.commit()
+                self.__pending_writes = 0
+
+    def close(self):
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.close()
+        # everything is committed, the journal only has to keep the uploads in flight
+        self.journal.close(compact=True)
+
+    def __insert(self, key: str, size: int, mtime_ns: int, content_hash: str):
+        self.__connection.execute(
+            'INSERT OR REPLACE INTO archived_files (key, size, mtime_ns, content_hash, archived_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, size, mtime_ns, content_hash, time.time())
+        )
+
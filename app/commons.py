@@ -1,27 +1,58 @@
+import json
+import multiprocessing.pool
+import os
 import pathlib
+import queue
+import struct
+import tempfile
+import threading
 from time import perf_counter
 from contextlib import contextmanager
+from typing import Iterator, Union
 
 import boto3
+from boto3.s3.transfer import ProgressCallbackInvoker, TransferConfig
 from botocore.config import Config
-
+from botocore.exceptions import ClientError
+from s3transfer.futures import NonThreadedExecutor
+from s3transfer.manager import TransferManager
+from s3transfer.utils import ReadFileChunk
+
+import archive_index
+import bandwidth
+import compression
 import constants
+import hashing
+import journal
+import metrics
+
+
+class FileRecord:
+    __slots__ = ('path_absolute', 'path_relative', 'size', 'mtime_ns')
+
+    def __init__(self, path_absolute: str, path_relative: str, size: int, mtime_ns: int):
+        self.path_absolute = path_absolute
+        self.path_relative = path_relative
+        self.size = size
+        self.mtime_ns = mtime_ns
 
 
 class FilesData:
 
-    def __init__(self):
+    def __init__(self, keep_files: bool = True):
+        """
+        :param keep_files: If false, only the count and size of the files are tracked.
+        """
         self.file_count = 0
         self.total_size = 0
         self.files = list()
+        self.__keep_files = keep_files
 
-    def register_file(self, file_size: int, file_path_absolute: str, file_path_relative: str):
+    def register_file(self, file: FileRecord):
         self.file_count += 1
-        self.total_size += file_size
-        self.files.append({
-            'path_relative': file_path_relative,
-            'path_absolute': file_path_absolute
-        })
+        self.total_size += file.size
+        if self.__keep_files:
+            self.files.append(file)
 
     def total_size_gb(self) -> float:
         return self.total_size/(1024*1024*1024)
@@ -40,42 +71,172 @@ def create_prefix_with_user_id(user_id: str, original_prefix: str) -> tuple[str,
         return f'{user_id}/{original_prefix}', f'{user_id}/'
 
 
-class ObjectsCount:
+class ObjectListing:
+    """
+    Compact list of objects: only the key (without the common prefix) and the size is kept, and the
+    records are spilled into a temporary file. This way memory use does not depend on the amount of
+    objects. It should be closed to remove the temporary file.
+    """
+    __record_header = struct.Struct('<QI')
 
-    def __init__(self, count: int, total_size: int, pages):
-        self.count = count
-        self.total_size = total_size
-        self.pages = pages
+    def __init__(self, key_prefix: str):
+        self.key_prefix = key_prefix
+        self.count = 0
+        self.total_size = 0
+        self.__file = tempfile.TemporaryFile(buffering=constants.LISTING_BUFFER_SIZE)
+
+    def add(self, key: str, size: int):
+        key_suffix = key.removeprefix(self.key_prefix).encode('utf-8')
+        self.__file.write(self.__record_header.pack(size, len(key_suffix)))
+        self.__file.write(key_suffix)
+        self.count += 1
+        self.total_size += size
+
+    def pages(self, page_size: int) -> Iterator[list[tuple[str, int]]]:
+        """
+        Read back the objects in pages.
+        :return: Pages of the full key and size of the objects.
+        """
+        self.__file.seek(0)
+        page = []
+        while header := self.__file.read(self.__record_header.size):
+            size, key_length = self.__record_header.unpack(header)
+            page.append((self.key_prefix + self.__file.read(key_length).decode('utf-8'), size))
+            if len(page) == page_size:
+                yield page
+                page = []
+        if len(page) > 0:
+            yield page
 
     def total_size_in_gb(self) -> float:
         return round(self.total_size / (1024*1024*1024), 3)
 
+    def close(self):
+        self.__file.close()
 
-def count_objects_with_prefix(s3_client, prefix: str) -> ObjectsCount:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def is_internal_key(key: str) -> bool:
     """
-    Counts how many objects exist with the given prefix.
-    :return: Both the count and the total size in bytes.
+    Decide if the object is used internally by this application (index, bundle), instead of
+    being an archived file.
+    """
+    return key.split('/', 1)[-1].startswith(constants.INTERNAL_FILE_PREFIX)
+
+
+def count_objects_with_prefix(s3_client, prefix: str, index: archive_index.ArchiveIndex = None) -> ObjectListing:
+    """
+    Counts how many objects exist with the given prefix. Internal objects are not counted,
+    and neither are objects that have a more recent entry in the index.
+    :return: Both the count and the total size in bytes, and the compact list of the objects.
+    """
+    object_listing = ObjectListing(prefix)
+    for objects in list_objects_sharded(s3_client, prefix):
+        for s3_object in objects:
+            if __is_archived_file(s3_object, index):
+                object_listing.add(s3_object['Key'], s3_object['Size'])
+    return object_listing
+
+
+def list_direct_children(s3_client, prefix: str) -> tuple[list[str], list[dict]]:
+    """
+    List only what is directly under the prefix, using a delimiter.
+    :return: The prefixes of the folders, and the objects.
     """
     paginator = s3_client.get_paginator('list_objects_v2')
     pages = paginator.paginate(
         Bucket=constants.ARCHIVE_BUCKET_NAME,
         Prefix=prefix,
+        Delimiter='/',
         PaginationConfig={
-            'PageSize': constants.MAX_PAGE_SIZE
+            'PageSize': constants.LIST_PAGE_SIZE
         }
     )
 
-    saved_pages = []
-    object_count = 0
-    objects_total_size = 0
+    folders = []
+    objects = []
     for page in pages:
-        if 'Contents' in page:
-            for s3_object in page['Contents']:
-                object_count += 1
-                objects_total_size += s3_object['Size']
-            saved_pages.append(page)
+        folders.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+        objects.extend(page.get('Contents', []))
+    return folders, objects
+
 
-    return ObjectsCount(object_count, objects_total_size, saved_pages)
+def list_objects_sharded(s3_client, prefix: str) -> Iterator[list[dict]]:
+    """
+    List every object with the prefix. The sub folders of the prefix are discovered first, then
+    these shards are listed concurrently at full page size. Pages are yielded as they arrive, in
+    no particular order. Internal folders are not listed.
+    """
+    results = queue.Queue()
+
+    def list_folders(folder_prefix: str) -> list[str]:
+        paginator = s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=constants.ARCHIVE_BUCKET_NAME,
+            Prefix=folder_prefix,
+            Delimiter='/',
+            PaginationConfig={
+                'PageSize': constants.LIST_PAGE_SIZE
+            }
+        )
+        folders = []
+        for page in pages:
+            folders.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', [])
+                           if not is_internal_key(common_prefix['Prefix']))
+            if 'Contents' in page:
+                results.put(page['Contents'])
+        return folders
+
+    def list_shard(shard: str):
+        paginator = s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=constants.ARCHIVE_BUCKET_NAME,
+            Prefix=shard,
+            PaginationConfig={
+                'PageSize': constants.LIST_PAGE_SIZE
+            }
+        )
+        for page in pages:
+            if 'Contents' in page:
+                results.put(page['Contents'])
+
+    def list_all():
+        try:
+            # go down the folders level by level, until there are enough of them to list in parallel
+            shards = [prefix]
+            for _ in range(constants.LIST_SHARD_DISCOVERY_DEPTH):
+                if len(shards) == 0 or len(shards) >= constants.LIST_SHARD_TARGET_COUNT:
+                    break
+                shards = [folder for folders in thread_pool.map(list_folders, shards) for folder in folders]
+            thread_pool.map(list_shard, shards, chunksize=1)
+            results.put(None)
+        except BaseException as e:
+            results.put(e)
+
+    thread_pool = metrics.run_thread_pool(constants.THREADS)
+    lister = threading.Thread(target=list_all, daemon=True)
+    lister.start()
+    try:
+        while (objects := results.get()) is not None:
+            if isinstance(objects, BaseException):
+                raise objects
+            yield objects
+    finally:
+        lister.join()
+        thread_pool.close()
+        thread_pool.join()
+
+
+def __is_archived_file(s3_object, index: archive_index.ArchiveIndex) -> bool:
+    key = s3_object['Key']
+    if is_internal_key(key):
+        return False
+    return index is None or index.keep_plain_object(key.split('/', 1)[-1], s3_object['LastModified'])
 
 
 def extract_command_arguments(command: str) -> str:
@@ -86,52 +247,529 @@ def extract_quoted_argument(command: str) -> str:
     return (command.split('"'))[1].split('"')[0]
 
 
+def extract_command_flags(command: str) -> dict[str, Union[str, bool]]:
+    """
+    Find the optional flags of a command, such as "--pack" or "--depth=2".
+    :return: Value of each flag, or True if the flag has no value.
+    """
+    flags = dict()
+    for token in command.split(sep=' '):
+        if token.startswith('--'):
+            name, separator, value = token[2:].partition('=')
+            flags[name] = value if separator else True
+    return flags
+
+
 def validate_root_folder(root: pathlib.Path):
     if not root.exists() or not root.is_dir():
         raise Exception('Root of the archive must be an existing folder!')
 
 
-def get_files_data(root: pathlib.Path, absolute_path: pathlib.Path) -> FilesData:
+def get_files_data(root: pathlib.Path, absolute_path: pathlib.Path, keep_files: bool = True) -> FilesData:
     """
     Gather stats about the affected files.
     """
+    data = FilesData(keep_files)
+    for file in scan_files(root, absolute_path):
+        data.register_file(file)
+    return data
+
+
+def scan_files(root: pathlib.Path, absolute_path: pathlib.Path) -> Iterator[FileRecord]:
+    """
+    Find all files under the path. Directories are walked in parallel with os.scandir, and the
+    files are yielded as soon as their directory is scanned, so they can be processed while the
+    scan continues. Internal files of this application are skipped.
+    """
     if not absolute_path.exists() or not absolute_path.is_dir():
         raise Exception('Path specified must point to an existing directory')
 
-    data = FilesData()
-    for file in pathlib.Path(absolute_path).rglob('*.*'):
-        if file.is_file():
-            absolute_path_string = file.as_posix()
-            relative_path_string = file.relative_to(root).as_posix()
-            # print(f'Found file: {absolute_path_string} ({relative_path_string})')
-            data.register_file(file.stat().st_size, absolute_path_string, relative_path_string)
-    return data
+    # the root may be relative (such as "."), the scanned paths must start with it exactly
+    root_prefix = os.path.join(os.path.abspath(root), '')
+    results = queue.Queue()
+    pending_lock = threading.Lock()
+    pending_directories = [1]
+    stopped = threading.Event()
+    thread_pool = multiprocessing.pool.ThreadPool(processes=constants.SCAN_THREADS)
+
+    def scan_directory(directory: str):
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if stopped.is_set():
+                        break
+                    if entry.is_dir(follow_symlinks=False):
+                        with pending_lock:
+                            pending_directories[0] += 1
+                        thread_pool.apply_async(scan_directory, (entry.path,))
+                        continue
+                    try:
+                        if not entry.is_file() or entry.name.startswith(constants.INTERNAL_FILE_PREFIX):
+                            continue
+                        entry_stat = entry.stat()
+                    except OSError as e:
+                        # only this file is left out, not the rest of its directory
+                        print(f'Failed to read the file "{entry.path}": {e}')
+                        continue
+                    path_absolute = entry.path.replace(os.sep, '/')
+                    path_relative = entry.path[len(root_prefix):].replace(os.sep, '/')
+                    files.append(FileRecord(path_absolute, path_relative, entry_stat.st_size, entry_stat.st_mtime_ns))
+        except OSError as e:
+            print(f'Failed to scan the directory "{directory}": {e}')
+        finally:
+            results.put(files)
+            with pending_lock:
+                pending_directories[0] -= 1
+                if pending_directories[0] == 0:
+                    results.put(None)
+
+    thread_pool.apply_async(scan_directory, (os.path.abspath(absolute_path),))
+    try:
+        while (files := results.get()) is not None:
+            yield from files
+    finally:
+        stopped.set()
+        thread_pool.close()
+        thread_pool.join()
+
+
+class TransferBudget:
+    """
+    Global limit on the amount of bytes that all transfers may have in flight at the same time.
+    """
+
+    def __init__(self, max_in_flight_bytes: int):
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.__in_flight_bytes = 0
+        self.__condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, amount: int):
+        # a single transfer larger than the budget may still run, but only alone
+        amount = min(amount, self.max_in_flight_bytes)
+        wait_start = perf_counter()
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__in_flight_bytes + amount <= self.max_in_flight_bytes)
+            self.__in_flight_bytes += amount
+            in_flight_bytes = self.__in_flight_bytes
+        metrics.count('budget_wait_seconds', perf_counter() - wait_start)
+        metrics.sample('in_flight_bytes', in_flight_bytes)
+        try:
+            yield
+        finally:
+            with self.__condition:
+                self.__in_flight_bytes -= amount
+                self.__condition.notify_all()
+
+
+class PartialDownload:
+    """
+    State of a large download: the content goes into a preallocated part file next to the target file, and the
+    completed byte ranges are recorded in a checkpoint file, with the digests of their content chunks. Both are renamed
+    or removed once all ranges are done.
+    """
+
+    def __init__(self, path: pathlib.Path, etag: str, size: int, part_size: int):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        self.part_size = part_size
+        self.part_path = path.with_name(f'{constants.INTERNAL_FILE_PREFIX}_{path.name}{constants.DOWNLOAD_PART_SUFFIX}')
+        self.checkpoint_path = path.with_name(f'{constants.INTERNAL_FILE_PREFIX}_{path.name}{constants.DOWNLOAD_CHECKPOINT_SUFFIX}')
+        self.completed_parts = set()
+        self.chunk_digests = dict()
+        self.__lock = threading.Lock()
+
+    def prepare(self):
+        """
+        Continue from the checkpoint if it belongs to the same version of the object, otherwise start over.
+        """
+        checkpoint = self.__read_checkpoint()
+        if (checkpoint is not None and checkpoint['etag'] == self.etag and checkpoint['size'] == self.size
+                and checkpoint['part_size'] == self.part_size and self.part_path.exists()
+                and self.part_path.stat().st_size == self.size):
+            self.completed_parts = set(checkpoint['completed_parts'])
+            self.chunk_digests = {int(part_number): [bytes.fromhex(digest) for digest in digests]
+                                  for part_number, digests in checkpoint.get('chunk_digests', dict()).items()}
+            if len(self.completed_parts) > 0:
+                print(f'Resuming the download of "{self.path.name}", {len(self.completed_parts)}/{self.part_count()} parts are already downloaded.')
+            return
+        self.completed_parts = set()
+        self.chunk_digests = dict()
+        with open(self.part_path, 'wb') as part_file:
+            part_file.truncate(self.size)
+        self.__write_checkpoint()
+
+    def part_count(self) -> int:
+        return max(1, -(-self.size // self.part_size))
+
+    def part_range(self, part_number: int) -> tuple[int, int]:
+        start = part_number * self.part_size
+        return start, min(start + self.part_size, self.size) - 1
+
+    def missing_parts(self) -> list[int]:
+        return [part_number for part_number in range(self.part_count()) if part_number not in self.completed_parts]
+
+    def complete_part(self, part_number: int, chunk_digests: list[bytes] = None):
+        with self.__lock:
+            self.completed_parts.add(part_number)
+            if chunk_digests is not None:
+                self.chunk_digests[part_number] = chunk_digests
+            self.__write_checkpoint()
+
+    def content_hash(self) -> Union[str, None]:
+        """
+        The tree hash of the downloaded content, if the digests of every range are known.
+        """
+        if any(part_number not in self.chunk_digests for part_number in range(self.part_count())):
+            return None
+        return hashing.combine_chunk_digests([digest for part_number in range(self.part_count()) for digest in self.chunk_digests[part_number]])
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        self.checkpoint_path.unlink(missing_ok=True)
+
+    def discard_if_empty(self):
+        """
+        Nothing is worth keeping if not even a single range was downloaded, for example when the object is not restored.
+        """
+        if len(self.completed_parts) == 0:
+            self.discard()
+
+    def discard(self):
+        self.part_path.unlink(missing_ok=True)
+        self.checkpoint_path.unlink(missing_ok=True)
+
+    def __read_checkpoint(self) -> Union[dict, None]:
+        try:
+            with open(self.checkpoint_path, 'r') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return None
+
+    def __write_checkpoint(self):
+        checkpoint = {
+            'etag': self.etag,
+            'size': self.size,
+            'part_size': self.part_size,
+            'completed_parts': sorted(self.completed_parts),
+            'chunk_digests': {part_number: [digest.hex() for digest in digests] for part_number, digests in self.chunk_digests.items()}
+        }
+        temporary_path = self.checkpoint_path.with_name(self.checkpoint_path.name + '.tmp')
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
+
 
+class TransferEngine:
+    """
+    Uploads and downloads objects with a transfer configuration that is chosen based on the
+    size of the object: small files are sent in a single request, large files are split into
+    parts that are transferred in parallel. All transfers share the same in flight bytes budget.
+    """
 
-def batch(iterable, n=1):
+    def __init__(
+            self,
+            part_size: int = None,
+            max_part_concurrency: int = constants.TRANSFER_MAX_PART_CONCURRENCY,
+            max_in_flight_bytes: int = constants.TRANSFER_MAX_IN_FLIGHT_BYTES,
+            bandwidth_limiter: bandwidth.BandwidthLimiter = None
+    ):
+        """
+        :param part_size: Fixed part size, or None to select it automatically from the file size.
+        :param max_part_concurrency: How many parts of a single file can be transferred in parallel.
+        :param max_in_flight_bytes: Limit of the bytes in flight across all transfers.
+        :param bandwidth_limiter: Limiter shared by all transfers, by default it follows the bandwidth schedule file.
+        """
+        self.part_size = part_size
+        self.max_part_concurrency = max_part_concurrency
+        self.budget = TransferBudget(max_in_flight_bytes)
+        if bandwidth_limiter is None:
+            bandwidth_limiter = bandwidth.BandwidthLimiter(bandwidth.load_bandwidth_schedule(constants.BANDWIDTH_FILE_NAME))
+        self.bandwidth = bandwidth_limiter
+
+    def select_part_size(self, size: int) -> int:
+        if self.part_size is not None:
+            return self.part_size
+        # aim for a fixed amount of parts, so that huge files don't need thousands of requests
+        part_size = -(-size // constants.TRANSFER_TARGET_PART_COUNT)
+        part_size = -(-part_size // constants.TRANSFER_PART_SIZE_ALIGNMENT) * constants.TRANSFER_PART_SIZE_ALIGNMENT
+        return min(max(part_size, constants.TRANSFER_MIN_PART_SIZE), constants.TRANSFER_MAX_PART_SIZE)
+
+    def config_for(self, size: int) -> TransferConfig:
+        part_size = self.select_part_size(size)
+        part_count = max(1, -(-size // part_size))
+        concurrency = min(self.max_part_concurrency, part_count)
+        return TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=concurrency,
+            use_threads=concurrency > 1
+        )
+
+    def in_flight_size(self, size: int) -> int:
+        config = self.config_for(size)
+        return min(size, config.multipart_chunksize * config.max_concurrency)
+
+    def upload_file(self, s3_client, filename: str, size: int, key: str, extra_args: dict,
+                    archive_journal: journal.ArchiveJournal = None, content_hash: str = None):
+        """
+        Upload a file. If a journal is given, the multipart upload of a large file and its completed parts are
+        recorded in it, and the upload of the same content continues with the missing parts when it is started again.
+        """
+        if archive_journal is not None and size > self.select_part_size(size):
+            with self.budget.reserve(self.in_flight_size(size)):
+                self.__upload_parts(s3_client, filename, size, key, extra_args, archive_journal, content_hash)
+            return
+        self.__upload(s3_client, filename, size, key, extra_args)
+
+    def upload_fileobj(self, s3_client, fileobj, size: int, key: str, extra_args: dict):
+        """
+        Upload a stream, such as compressed content. The size is the expected upper bound of its length.
+        """
+        self.__upload(s3_client, fileobj, size, key, extra_args)
+
+    def __upload(self, s3_client, source, size: int, key: str, extra_args: dict):
+        """
+        Upload a file name or a stream with s3transfer. Its worker threads report to the metrics run of the caller.
+        """
+        config = self.config_for(size)
+        executor_cls = metrics.RunThreadPoolExecutor if config.use_threads else NonThreadedExecutor
+        with self.budget.reserve(self.in_flight_size(size)), TransferManager(s3_client, config, executor_cls=executor_cls) as manager:
+            future = manager.upload(source, constants.ARCHIVE_BUCKET_NAME, key, extra_args,
+                                    subscribers=[ProgressCallbackInvoker(self.bandwidth.consume)])
+            future.result()
+
+    def __upload_parts(self, s3_client, filename: str, size: int, key: str, extra_args: dict,
+                       archive_journal: journal.ArchiveJournal, content_hash: str):
+        part_size = self.select_part_size(size)
+        upload_id, parts = self.__resume_upload(s3_client, key, size, content_hash, part_size, archive_journal)
+        if upload_id is None:
+            response = s3_client.create_multipart_upload(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key, **extra_args)
+            upload_id = response['UploadId']
+            archive_journal.record_upload_started(key, upload_id, part_size, size, content_hash)
+        elif len(parts) > 0:
+            print(f'Resuming the upload of "{key}", {len(parts)}/{-(-size // part_size)} parts are already uploaded.')
+
+        missing_parts = [part_number for part_number in range(1, -(-size // part_size) + 1) if part_number not in parts]
+        concurrency = max(1, min(self.max_part_concurrency, len(missing_parts)))
+        with metrics.RunThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(self.__upload_part, s3_client, filename, size, key, upload_id, part_size, part_number, archive_journal)
+                       for part_number in missing_parts]
+            for future in futures:
+                part_number, etag = future.result()
+                parts[part_number] = etag
+        s3_client.complete_multipart_upload(
+            Bucket=constants.ARCHIVE_BUCKET_NAME,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': part_number, 'ETag': parts[part_number]} for part_number in sorted(parts)]}
+        )
+        archive_journal.record_upload_finished(upload_id)
+
+    def __resume_upload(self, s3_client, key: str, size: int, content_hash: str, part_size: int,
+                        archive_journal: journal.ArchiveJournal) -> tuple[Union[str, None], dict]:
+        """
+        Find the upload of the same content in the journal. Only the parts that S3 also lists with the
+        same ETag are kept, the upload may have been aborted, or a part may have been overwritten since.
+        :return: The ID of the upload, or None if it has to be started, and the completed parts.
+        """
+        upload = archive_journal.upload_of(key)
+        if upload is None:
+            return None, dict()
+        if upload.size != size or upload.content_hash != content_hash or upload.part_size != part_size:
+            # the file has changed since
+            abort_multipart_upload(s3_client, archive_journal, upload)
+            return None, dict()
+        try:
+            listed_parts = dict()
+            for page in s3_client.get_paginator('list_parts').paginate(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key, UploadId=upload.upload_id):
+                for part in page.get('Parts', []):
+                    listed_parts[part['PartNumber']] = part['ETag']
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+            archive_journal.record_upload_finished(upload.upload_id)
+            return None, dict()
+        return upload.upload_id, {part_number: etag for part_number, etag in upload.parts.items() if listed_parts.get(part_number) == etag}
+
+    def __upload_part(self, s3_client, filename: str, size: int, key: str, upload_id: str, part_size: int, part_number: int,
+                      archive_journal: journal.ArchiveJournal) -> tuple[int, str]:
+        start = (part_number - 1) * part_size
+        length = min(part_size, size - start)
+        self.bandwidth.consume(length)
+        # the part is streamed from the file, parts can be gigabytes, and several of them are in flight
+        with ReadFileChunk.from_filename(filename, start, length, enable_callbacks=False) as body:
+            response = s3_client.upload_part(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=body
+            )
+        archive_journal.record_part(upload_id, part_number, response['ETag'])
+        return part_number, response['ETag']
+
+    def download_object(self, s3_client, key: str, size: int, path: pathlib.Path):
+        """
+        Download the object into the file, and decompress it on the fly if it was uploaded compressed. Large
+        objects are downloaded in byte ranges next to the file, and an interrupted download continues with
+        the missing ranges when it is started again. The content is verified with its hash while it is written,
+        a corrupted file is deleted and hashing.ContentHashMismatch is raised.
+        """
+        part_size = self.select_part_size(size)
+        if size <= part_size:
+            # a single request is needed anyway, and it also returns the metadata
+            with self.budget.reserve(size):
+                response = s3_client.get_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+                with open(path, 'wb') as fileobj:
+                    verified = self.__write_object_body(response, fileobj)
+            if not verified:
+                path.unlink()
+                raise hashing.ContentHashMismatch(key)
+            return
+
+        head_response = s3_client.head_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+        partial_download = PartialDownload(path, head_response['ETag'], size, part_size)
+        if compression.CODEC_METADATA_KEY in head_response['Metadata']:
+            # compressed content can only be streamed in order, so it can't be resumed
+            with self.budget.reserve(part_size):
+                response = s3_client.get_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key, IfMatch=partial_download.etag)
+                with open(partial_download.part_path, 'wb') as fileobj:
+                    verified = self.__write_object_body(response, fileobj)
+        else:
+            self.__download_ranges(s3_client, key, partial_download)
+            verified = self.__verify_ranges(partial_download, hashing.content_hash_of_metadata(head_response['Metadata']))
+        if not verified:
+            partial_download.discard()
+            raise hashing.ContentHashMismatch(key)
+        partial_download.finish()
+
+    def __download_ranges(self, s3_client, key: str, partial_download: 'PartialDownload'):
+        partial_download.prepare()
+        missing_parts = partial_download.missing_parts()
+        concurrency = max(1, min(self.max_part_concurrency, len(missing_parts)))
+        try:
+            with metrics.RunThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(self.__download_range, s3_client, key, partial_download, part_number)
+                           for part_number in missing_parts]
+                for future in futures:
+                    future.result()
+        except BaseException:
+            partial_download.discard_if_empty()
+            raise
+
+    def __verify_ranges(self, partial_download: 'PartialDownload', content_hash: Union[str, None]) -> bool:
+        """
+        Combine the digests of the ranges into the tree hash of the content. A plain SHA-256 can't be calculated
+        from ranges, objects uploaded before the tree hash are verified with the --verify flag of the next download.
+        """
+        if content_hash is None or hashing.is_legacy_hash(content_hash):
+            return True
+        downloaded_hash = partial_download.content_hash()
+        if downloaded_hash is None:
+            # a checkpoint of an older version has no digests, or the ranges are not aligned to the chunks
+            downloaded_hash = hashing.hash_file(str(partial_download.part_path))
+        return downloaded_hash == content_hash
+
+    def __download_range(self, s3_client, key: str, partial_download: 'PartialDownload', part_number: int):
+        start, end = partial_download.part_range(part_number)
+        hasher = hashing.TreeHasher() if partial_download.part_size % constants.HASH_CHUNK_SIZE == 0 else None
+        with self.budget.reserve(end - start + 1):
+            response = s3_client.get_object(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=key,
+                Range=f'bytes={start}-{end}',
+                IfMatch=partial_download.etag
+            )
+            with open(partial_download.part_path, 'r+b') as part_file:
+                part_file.seek(start)
+                for chunk in response['Body'].iter_chunks(constants.COMPRESSION_READ_SIZE):
+                    self.bandwidth.consume(len(chunk))
+                    part_file.write(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+                part_file.flush()
+                os.fsync(part_file.fileno())
+        partial_download.complete_part(part_number, hasher.chunk_digests() if hasher is not None else None)
+
+    def read_chunks(self, get_object_response) -> Iterator[bytes]:
+        """
+        Read the body of a GET response within the bandwidth limit.
+        """
+        for chunk in get_object_response['Body'].iter_chunks(constants.COMPRESSION_READ_SIZE):
+            self.bandwidth.consume(len(chunk))
+            yield chunk
+
+    def __write_object_body(self, get_object_response, fileobj) -> bool:
+        """
+        :return: False if the written content does not match the content hash in the metadata of the object.
+        """
+        codec = get_object_response['Metadata'].get(compression.CODEC_METADATA_KEY)
+        content_hash = hashing.content_hash_of_metadata(get_object_response['Metadata'])
+        hasher = None
+        if content_hash is not None:
+            hasher = hashing.create_hasher(content_hash)
+            fileobj = hashing.HashingWriter(fileobj, hasher)
+        chunks = self.read_chunks(get_object_response)
+        if codec is not None:
+            compression.write_decompressed(chunks, codec, fileobj)
+        else:
+            for chunk in chunks:
+                fileobj.write(chunk)
+        return hasher is None or hasher.hexdigest() == content_hash
+
+
+def abort_multipart_upload(s3_client, archive_journal: journal.ArchiveJournal, upload: journal.JournalUpload):
     """
-    Batch an iterable into the given sized chunks.
+    Abort an upload of the journal, so that its parts are no longer stored (and charged).
     """
-    l = len(iterable)
-    for ndx in range(0, l, n):
-        yield iterable[ndx:min(ndx + n, l)]
+    try:
+        s3_client.abort_multipart_upload(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=upload.key, UploadId=upload.upload_id)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+    archive_journal.record_upload_finished(upload.upload_id)
+
+
+s3_clients = dict()
+s3_clients_lock = threading.Lock()
 
 
 def build_s3_client(aws_session: boto3.Session):
-    return aws_session.client(
-        service_name='s3',
-        region_name=constants.AWS_REGION
-    )
+    return __cached_s3_client(aws_session, accelerated=False)
 
 
 def build_s3_client_accelerated(aws_session: boto3.Session):
-    return aws_session.client(
-        service_name='s3',
-        region_name=constants.AWS_REGION,
-        config=Config(s3={
-            'use_accelerate_endpoint': True
-        })
-    )
+    return __cached_s3_client(aws_session, accelerated=True)
+
+
+def __cached_s3_client(aws_session: boto3.Session, accelerated: bool):
+    """
+    Clients are thread safe, so one client is created per session and endpoint, and it is shared by every
+    thread. Creating a client parses the service model, and its connections (with their TLS handshakes) are
+    kept alive in the pool between the commands. Creating clients from a session is not thread safe, hence the lock.
+    The endpoint can be overridden with an environment variable, for example to run against a local S3 emulator.
+    """
+    endpoint_url = os.environ.get(constants.S3_ENDPOINT_URL_VARIABLE)
+    cache_key = (id(aws_session), accelerated)
+    with s3_clients_lock:
+        if cache_key not in s3_clients:
+            if endpoint_url is not None:
+                # emulators have no accelerate endpoint, and no DNS for the bucket subdomains
+                s3_config = {'use_accelerate_endpoint': False, 'addressing_style': 'path'}
+            else:
+                s3_config = {'use_accelerate_endpoint': accelerated}
+            config = Config(
+                max_pool_connections=constants.S3_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                s3=s3_config
+            )
+            s3_client = aws_session.client(service_name='s3', region_name=constants.AWS_REGION, endpoint_url=endpoint_url, config=config)
+            metrics.instrument(s3_client)
+            s3_clients[cache_key] = (aws_session, s3_client)
+        return s3_clients[cache_key][1]
 
 
 @contextmanager
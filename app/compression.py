@@ -0,0 +1,119 @@
+import collections
+import math
+import os
+import zlib
+
+import constants
+
+try:
+    import zstandard
+except ImportError:
+    # optional dependency, zlib from the standard library is used without it
+    zstandard = None
+
+CODEC_ZSTD = 'zstd'
+CODEC_ZLIB = 'zlib'
+DEFAULT_CODEC = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+# key of the object metadata that stores the codec
+CODEC_METADATA_KEY = 'codec'
+ORIGINAL_SIZE_METADATA_KEY = 'original-size'
+
+
+class NotSmallerError(Exception):
+    """
+    The compressed content is not smaller than the original, so it should be stored without compression.
+    """
+
+
+def create_compressor(codec: str):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=constants.COMPRESSION_LEVEL_ZSTD).compressobj()
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(constants.COMPRESSION_LEVEL_ZLIB)
+    raise Exception(f'Unknown compression codec: {codec}')
+
+
+def create_decompressor(codec: str):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception('This object was compressed with zstd, install the "zstandard" package to download it')
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    raise Exception(f'Unknown compression codec: {codec}')
+
+
+def is_compressible(path: str, size: int) -> bool:
+    """
+    Decide if compressing the file is worth it. Tiny files and well known compressed formats are
+    skipped, for the rest the entropy of a sample from the start of the file decides.
+    """
+    if size < constants.COMPRESSION_MIN_SIZE:
+        return False
+    if os.path.splitext(path)[1].lower() in constants.COMPRESSION_SKIPPED_EXTENSIONS:
+        return False
+    with open(path, 'rb') as file:
+        sample = file.read(constants.COMPRESSION_SAMPLE_SIZE)
+    return sample_entropy(sample) < constants.COMPRESSION_MAX_ENTROPY
+
+
+def sample_entropy(sample: bytes) -> float:
+    """
+    Shannon entropy of the sample in bits per byte: 8 means random (incompressible) data.
+    """
+    if len(sample) == 0:
+        return 0.0
+    entropy = 0.0
+    for count in collections.Counter(sample).values():
+        probability = count / len(sample)
+        entropy -= probability * math.log2(probability)
+    return entropy
+
+
+class CompressingReader:
+    """
+    Readable file object that returns the compressed content of the wrapped file, so it can be
+    streamed into an upload without writing a compressed copy to the disk.
+    """
+
+    def __init__(self, file, codec: str, original_size: int):
+        """
+        :param original_size: Size of the wrapped file. Reading fails with NotSmallerError as soon as the compressed
+        content reaches it, so the upload is abandoned before it completes.
+        """
+        self.__file = file
+        self.__compressor = create_compressor(codec)
+        self.__original_size = original_size
+        self.__compressed_size = 0
+        self.__buffer = bytearray()
+        self.__finished = False
+
+    def read(self, size: int = -1) -> bytes:
+        while not self.__finished and (size < 0 or len(self.__buffer) < size):
+            chunk = self.__file.read(constants.COMPRESSION_READ_SIZE)
+            if chunk:
+                compressed = self.__compressor.compress(chunk)
+            else:
+                compressed = self.__compressor.flush()
+                self.__finished = True
+            self.__compressed_size += len(compressed)
+            if self.__compressed_size >= self.__original_size:
+                raise NotSmallerError(f'The compressed content is not smaller than {self.__original_size} bytes')
+            self.__buffer += compressed
+        if size < 0:
+            size = len(self.__buffer)
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+
+def write_decompressed(chunks, codec: str, fileobj):
+    """
+    Decompress the streamed chunks of an object while writing them into the file.
+    """
+    decompressor = create_decompressor(codec)
+    for chunk in chunks:
+        fileobj.write(decompressor.decompress(chunk))
+    if hasattr(decompressor, 'flush'):
+        fileobj.write(decompressor.flush())
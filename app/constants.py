@@ -8,7 +8,114 @@ ARCHIVE_BUCKET_NAME = 'personaldeeparchive-archive-data-eu-central-1'
 SOURCE_DOCS_URL = 'https://github.com/Gtomika/personal-deep-archive'
 DOWNLOAD_FOLDER = 'downloads'
 THREADS = 10
+SCAN_THREADS = 16
 MAX_PAGE_SIZE = 100
+LIST_PAGE_SIZE = 1000
+LIST_SHARD_TARGET_COUNT = 50
+LIST_SHARD_DISCOVERY_DEPTH = 3
+LISTING_BUFFER_SIZE = 1024 * 1024
 
+# requests in flight at the same time: small requests are bound by latency, so many of them can be sent at once
+RESTORE_INITIAL_CONCURRENCY = 32
+RESTORE_MAX_CONCURRENCY = 512
+HEAD_INITIAL_CONCURRENCY = 32
+HEAD_MAX_CONCURRENCY = 256
+WATCH_DOWNLOAD_CONCURRENCY = 64
+DOWNLOAD_INITIAL_CONCURRENCY = 8
+DOWNLOAD_MAX_CONCURRENCY = 128
+UPLOAD_INITIAL_CONCURRENCY = 8
+UPLOAD_MAX_CONCURRENCY = 128
+
+# the concurrency is adapted to the observed throughput, throttling and latency
+ADAPTIVE_MIN_CONCURRENCY = 2
+ADAPTIVE_WINDOW_SECONDS = 2.0
+ADAPTIVE_DECREASE_FACTOR = 0.5
+ADAPTIVE_LATENCY_FACTOR = 2.0
+ADAPTIVE_IMPROVEMENT_FACTOR = 1.05
+ADAPTIVE_REPORTED_CHANGES = 10
+
+# multipart transfers: the part size is selected from the file size within these limits
+TRANSFER_MIN_PART_SIZE = 8 * 1024 * 1024
+TRANSFER_MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+TRANSFER_PART_SIZE_ALIGNMENT = 1024 * 1024
+TRANSFER_TARGET_PART_COUNT = 1000
+TRANSFER_MAX_PART_CONCURRENCY = 8
+TRANSFER_MAX_IN_FLIGHT_BYTES = 1024 * 1024 * 1024
+# the shared clients need a connection for every request in flight, and the parts of large transfers need more
+S3_MAX_POOL_CONNECTIONS = RESTORE_MAX_CONCURRENCY + TRANSFER_MAX_IN_FLIGHT_BYTES // TRANSFER_MIN_PART_SIZE
+DOWNLOAD_PART_SUFFIX = '.part'
+DOWNLOAD_CHECKPOINT_SUFFIX = '.checkpoint'
+
+# optional bandwidth limit of the transfers, depending on the time of the day
+BANDWIDTH_FILE_NAME = 'bandwidth.json'
+
+# the session of the previous run is continued, if its credentials are valid at least this long
+SESSION_FILE_NAME = 'session.json'
+SESSION_MIN_CREDENTIALS_LIFETIME_SECONDS = 15 * 60
+
+S3_ENDPOINT_URL_VARIABLE = 'DEEP_ARCHIVE_S3_ENDPOINT_URL'
+S3_THROTTLING_ERROR_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException'}
 S3_STANDARD = 'STANDARD'
 S3_DEEP_ARCHIVE = 'DEEP_ARCHIVE'
+
+# local bookkeeping files are placed into the root, and are never archived
+INTERNAL_FILE_PREFIX = '.deep_archive'
+CATALOG_FILE_NAME = f'{INTERNAL_FILE_PREFIX}_catalog.sqlite'
+CATALOG_COMMIT_INTERVAL = 500
+# progress of the archive command, written in batches, at least once per interval
+JOURNAL_FILE_NAME = f'{INTERNAL_FILE_PREFIX}_journal.jsonl'
+JOURNAL_FLUSH_INTERVAL_SECONDS = 1.0
+JOURNAL_MAX_BUFFERED_RECORDS = 1000
+# multipart uploads that were not resumed for this long are aborted, the bucket lifecycle does the same after 7 days
+MULTIPART_UPLOAD_MAX_AGE_SECONDS = 6 * 24 * 60 * 60
+HASH_CHUNK_SIZE = 1024 * 1024
+# files at least this large are hashed in segments by a process pool
+HASH_PARALLEL_THRESHOLD = 64 * 1024 * 1024
+HASH_SEGMENT_SIZE = 32 * 1024 * 1024
+
+# small files can be packed into bundles, their location is saved into index objects
+PACK_FILE_SIZE_THRESHOLD = 1024 * 1024
+BUNDLE_TARGET_SIZE = 256 * 1024 * 1024
+BUNDLE_FOLDER = f'{INTERNAL_FILE_PREFIX}_bundles/'
+INDEX_FOLDER = f'{INTERNAL_FILE_PREFIX}_index/'
+INDEX_MAX_ENTRIES = 100000
+
+# deduplicated files are stored once, under the hash of their content
+BLOB_FOLDER = f'{INTERNAL_FILE_PREFIX}_blobs/'
+
+# optional compression of uploaded files
+COMPRESSION_LEVEL_ZSTD = 3
+COMPRESSION_LEVEL_ZLIB = 6
+COMPRESSION_MIN_SIZE = 4 * 1024
+COMPRESSION_SAMPLE_SIZE = 16 * 1024
+COMPRESSION_MAX_ENTROPY = 7.5
+COMPRESSION_READ_SIZE = 1024 * 1024
+COMPRESSION_SKIPPED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp4', '.mov', '.mkv', '.avi', '.webm', '.mp3', '.aac',
+    '.ogg', '.flac', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst', '.docx', '.xlsx', '.pptx'
+}
+
+# local record of the submitted restore requests
+RESTORE_STATE_FILE_NAME = f'{INTERNAL_FILE_PREFIX}_restores.sqlite'
+RESTORE_DAYS = 10
+RESTORE_PENDING_TIMEOUT_SECONDS = 48 * 60 * 60
+RESTORE_EXPIRY_MARGIN_SECONDS = 12 * 60 * 60
+
+# watching restorations: objects in progress are polled with rate limited HEAD requests
+WATCH_POLL_INTERVAL_SECONDS = 15 * 60
+WATCH_FIRST_POLL_DELAY_SECONDS = 3 * 60 * 60
+WATCH_HEAD_BATCH_SIZE = 100
+WATCH_HEAD_REQUESTS_PER_SECOND = 50
+WATCH_POLL_CONCURRENCY = 16
+
+# every command run writes a metrics report into this folder, next to main.py
+METRICS_FOLDER = 'metrics'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_TRACEMALLOC_FRAMES = 5
+METRICS_PROFILE_TOP_ENTRIES = 40
+
+# the progress line of long commands is refreshed this often, without a terminal a line is printed less often
+PROGRESS_RENDER_INTERVAL_SECONDS = 0.5
+PROGRESS_PLAIN_INTERVAL_SECONDS = 10.0
+PROGRESS_RATE_WINDOW_SECONDS = 10.0
+PROGRESS_REPORTED_FAILURES = 20
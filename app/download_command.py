@@ -1,101 +1,435 @@
+import concurrent.futures
+import hashlib
+import itertools
 import time
-import traceback
 import pathlib
-import multiprocessing
-import threading
+from typing import Iterator, Union
 
 import boto3
 import botocore.client
 
+import archive_index
+import async_core
 import commons
+import compression
 import constants
+import hashing
+import metrics
+import progress
+import restore_state
 
 
-def process_download_command(root_directory: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str):
+def process_download_command(root_directory: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
+    """
+    After a confirmation, download the restored objects with the given prefix.
+    :param root_directory: Root folder of the archive, the files are downloaded under it.
+    :param aws_session: AWS session with correct credentials that only allow the users prefix.
+    :param user_id: ID of the user used as S3 prefix.
+    :param command_data: Objects will be downloaded with this prefix.
+    :param flags: Optional flags of the command. With "--skip-existing" the files that are already downloaded
+    with the same size are skipped, and "--verify" also compares their checksum. With "--log=<file>", the outcome
+    of every object is written into the file.
+    """
     print(f'Checking the objects with prefix {command_data}')
+    skip_existing, verify = __skip_options(flags)
     full_prefix, internal_prefix = commons.create_prefix_with_user_id(user_id, command_data)
     download_path = __create_download_folder_path(root_directory)
 
     s3_client = commons.build_s3_client(aws_session)
-    object_count = commons.count_objects_with_prefix(s3_client, full_prefix)
+    index = archive_index.load_archive_index(s3_client, user_id)
+    with commons.count_objects_with_prefix(s3_client, full_prefix, index) as object_listing:
+        index_entries = index.entries_with_prefix(full_prefix.removeprefix(internal_prefix))
+        total_count = object_listing.count + len(index_entries)
+        total_size = object_listing.total_size + sum(entry.size for entry in index_entries)
+        total_size_gb = round(total_size / (1024*1024*1024), 3)
+
+        print(f'A total of {total_count} objects will be downloaded, with total size of {total_size_gb} GB!')
+        print(f'The downloaded files will be placed under {download_path.as_posix()}, in your selected root directory.')
+        print(f'A one time download fee will apply, depending on the size.')
+        proceed = input('Are you sure you want to proceed? (Y) ')
+
+        if proceed == 'Y':
+            print(f'Starting the download of all selected objects with up to {constants.DOWNLOAD_MAX_CONCURRENCY} downloads in flight at {time.ctime()}. This will take some time...')
+            with commons.catch_time() as download_timer:
+                download_totals = __download_objects(aws_session, object_listing, index_entries, download_path, internal_prefix,
+                                                     total_count, total_size, skip_existing, verify, flags.get('log'))
+            print(f'Download of the selected objects finished at {time.ctime()} (took {download_timer():.4f} seconds).'
+                  f' {download_totals.completed + download_totals.skipped}/{total_count} downloads were successfully completed.')
+            if skip_existing:
+                print(f'{download_totals.skipped} of these were already downloaded, and were skipped.')
+            if download_totals.deferred > 0:
+                print(f'{download_totals.deferred} objects are not restored, use "restore_data" to restore them.')
+        else:
+            print('Aborting download...')
+
+
+def process_watch_and_download_command(root_directory: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
+    """
+    Long-running version of the download command. Objects with the prefix that have a restoration in progress
+    are polled with HEAD requests, and each of them is downloaded as soon as it becomes restored.
+    :param root_directory: Root folder of the archive, the restore state index is stored here.
+    :param aws_session: AWS session with correct credentials that only allow the users prefix.
+    :param user_id: ID of the user used as S3 prefix.
+    :param command_data: Objects will be downloaded with this prefix.
+    :param flags: Optional flags of the command, "--interval=N" sets the minutes between polls. The flags
+    "--skip-existing", "--verify" and "--log=<file>" work the same as for the download command.
+    """
+    print(f'Checking the objects with prefix {command_data}')
+    skip_existing, verify = __skip_options(flags)
+    full_prefix, internal_prefix = commons.create_prefix_with_user_id(user_id, command_data)
+    download_path = __create_download_folder_path(root_directory)
+    poll_interval = int(flags['interval']) * 60 if 'interval' in flags else constants.WATCH_POLL_INTERVAL_SECONDS
 
-    print(f'A total of {object_count.count} objects will be downloaded, with total size of {object_count.total_size_in_gb()} GB!')
-    print(f'The downloaded files will be placed under {download_path.as_posix()}, in your selected root directory.')
-    print(f'A one time download fee will apply, depending on the size.')
-    proceed = input('Are you sure you want to proceed? (Y) ')
+    s3_client = commons.build_s3_client(aws_session)
+    index = archive_index.load_archive_index(s3_client, user_id)
+    state_index = restore_state.RestoreStateIndex(root_directory)
+    try:
+        with commons.count_objects_with_prefix(s3_client, full_prefix, index) as object_listing:
+            plain_objects = {key: size for page in object_listing.pages(constants.LIST_PAGE_SIZE) for key, size in page}
+        indexed_objects = dict()
+        for entry in index.entries_with_prefix(full_prefix.removeprefix(internal_prefix)):
+            indexed_objects.setdefault(entry.object_key, []).append(entry)
 
-    if proceed == 'Y':
-        print(f'Starting the download of all selected objects using {constants.THREADS} parallel processes at {time.ctime()}. This will take some time...')
-        with commons.catch_time() as download_timer:
-            downloads_completed = __download_objects(aws_session, object_count.pages, download_path, internal_prefix, object_count.count)
-        print(f'Download of the selected objects finished at {time.ctime()} (took {download_timer():.4f} seconds).'
-              f' {downloads_completed}/{object_count.count} downloads were successfully completed.')
-    else:
-        print('Aborting download...')
+        requested_keys = {state.key for state in state_index.states_with_prefix(internal_prefix)}
+        watched_keys = {key for key in itertools.chain(plain_objects, indexed_objects) if key in requested_keys}
+        total_count = sum(1 if key in plain_objects else len(indexed_objects[key]) for key in watched_keys)
+        total_size = sum(plain_objects[key] if key in plain_objects else sum(entry.size for entry in indexed_objects[key])
+                         for key in watched_keys)
+        not_requested_count = len(plain_objects) + len(indexed_objects) - len(watched_keys)
 
+        if not_requested_count > 0:
+            print(f'{not_requested_count} objects have no restoration recorded, these are not watched. Use "restore_data" to restore them.')
+        if total_count == 0:
+            print('There are no restored objects or restorations in progress with this prefix.')
+            return
+        print(f'A total of {total_count} files will be downloaded as they become restored, checking every {poll_interval // 60} minutes.')
+        print(f'The downloaded files will be placed under {download_path.as_posix()}, in your selected root directory.')
+        print(f'A one time download fee will apply, depending on the size.')
+        proceed = input('Are you sure you want to proceed? (Y) ')
 
-download_progress = 0
-download_success = 0
+        if proceed == 'Y':
+            print(f'Started watching the restorations at {time.ctime()}. Press Ctrl+C to stop.')
+            with commons.catch_time() as watch_timer:
+                download_totals = __watch_and_download(aws_session, state_index, watched_keys, plain_objects, indexed_objects,
+                                                       download_path, internal_prefix, total_count, total_size, poll_interval,
+                                                       skip_existing, verify, flags.get('log'))
+            print(f'Watching the restorations finished at {time.ctime()} (took {watch_timer():.4f} seconds).'
+                  f' {download_totals.completed + download_totals.skipped}/{total_count} downloads were successfully completed.')
+        else:
+            print('Aborting download...')
+    finally:
+        state_index.close()
 
 
 def __download_objects(
         aws_session: boto3.Session,
-        pages,
+        object_listing: commons.ObjectListing,
+        index_entries: list[archive_index.IndexEntry],
         download_path: pathlib.Path,
         internal_prefix: str,
-        total_files: int
-) -> int:
-    global download_progress, download_success
-
-    download_success = 0
-    download_progress = 0
-
-    thread_pool = multiprocessing.pool.ThreadPool(processes=constants.THREADS)
-    lock = threading.Lock()
-
-    for page in pages:
-        thread_pool.apply_async(__download_object_page, (aws_session, page, download_path, internal_prefix, total_files, lock))
+        total_files: int,
+        total_size: int,
+        skip_existing: bool,
+        verify: bool,
+        log_path: Union[str, None]
+) -> progress.WorkerCounters:
+    transfer_engine = commons.TransferEngine()
+    s3_client = commons.build_s3_client_accelerated(aws_session)
+    concurrency = async_core.AdaptiveConcurrency('downloads', constants.DOWNLOAD_INITIAL_CONCURRENCY, constants.DOWNLOAD_MAX_CONCURRENCY,
+                                                 watch_latency=False)
 
-    thread_pool.close()
-    thread_pool.join()
+    objects = (item for page in object_listing.pages(constants.LIST_PAGE_SIZE) for item in page)
+    with progress.Progress('Downloading', total_files, total_size, log_path) as download_progress, concurrency.watching(s3_client):
+        async_core.run_bounded(objects, __download_object,
+                               (s3_client, download_path, internal_prefix, download_progress, transfer_engine, skip_existing, verify),
+                               concurrency, units=lambda item: item[1] / (1024*1024))
+        async_core.run_bounded(index_entries, __download_index_entry,
+                               (s3_client, download_path, download_progress, transfer_engine, skip_existing, verify),
+                               concurrency, units=lambda entry: entry.size / (1024*1024))
+    concurrency.print_summary('MB/s')
 
-    return download_success
+    return download_progress.totals()
 
 
-def __download_object_page(
+def __watch_and_download(
         aws_session: boto3.Session,
-        page,
+        state_index: restore_state.RestoreStateIndex,
+        watched_keys: set[str],
+        plain_objects: dict[str, int],
+        indexed_objects: dict[str, list[archive_index.IndexEntry]],
         download_path: pathlib.Path,
         internal_prefix: str,
         total_files: int,
-        lock: threading.Lock
-):
-    global download_success
+        total_size: int,
+        poll_interval: int,
+        skip_existing: bool,
+        verify: bool,
+        log_path: Union[str, None]
+) -> progress.WorkerCounters:
+    """
+    Alternate between polling the objects that are not yet restored, and starting the download of the ones
+    that are ready. Downloads run in the background, so they overlap with the following polls.
+    """
+    transfer_engine = commons.TransferEngine()
+    s3_client = commons.build_s3_client(aws_session)
+    download_client = commons.build_s3_client_accelerated(aws_session)
+    waiting_keys = set(watched_keys)
+    downloads = dict()
 
-    s3_client = commons.build_s3_client_accelerated(aws_session)
-    if 'Contents' in page:
-        for s3_object in page['Contents']:
-            key = s3_object['Key']
-            user_friendly_key = key.removeprefix(internal_prefix)
-            absolute_path = download_path.joinpath(user_friendly_key)
-            progress_percent = __update_progress(lock, total_files)
+    def start_ready_downloads():
+        now = time.time()
+        for key in [key for key in waiting_keys if state_index.current_status(key, now) == restore_state.STATUS_READY]:
+            waiting_keys.remove(key)
+            if key in plain_objects:
+                future = executor.submit(__download_object, (key, plain_objects[key]), download_client, download_path,
+                                         internal_prefix, download_progress, transfer_engine, skip_existing, verify)
+            else:
+                future = executor.submit(__download_index_entries_of_object, indexed_objects[key], download_client, download_path,
+                                         download_progress, transfer_engine, skip_existing, verify)
+            downloads[future] = key
+
+    def collect_finished_downloads():
+        for future in [future for future in downloads if future.done()]:
+            key = downloads.pop(future)
             try:
-                with __create_download_file_for_object(absolute_path) as download_file:
-                    s3_client.download_fileobj(
-                        Bucket=constants.ARCHIVE_BUCKET_NAME,
-                        Key=key,
-                        Fileobj=download_file
-                    )
-                with lock:
-                    download_success += 1
-                print(f'The object "{user_friendly_key}" has been downloaded. {progress_percent}% complete.')
-            except s3_client.exceptions.InvalidObjectState:
-                print(f'The object "{user_friendly_key}" has NOT BEEN RESTORED, and so it cannot be downloaded. {progress_percent}% complete.')
-                __delete_empty_file(absolute_path)
-            except botocore.client.ClientError as e:
-                print(f'Failed to download S3 object with key "{user_friendly_key}": {e.response["Error"]["Code"]}! {progress_percent}% complete.')
-                traceback.print_exc()
-                __delete_empty_file(absolute_path)
+                restored = future.result()
+            except BaseException as e:
+                download_progress.failed(key.removeprefix(internal_prefix), f'unexpected error: {e!r}', with_traceback=True)
+                continue
+            if not restored:
+                # the local record was outdated, the next poll finds out the real state
+                state = state_index.lookup(key)
+                state_index.record_pending(key, state.requested_at if state is not None else None)
+                waiting_keys.add(key)
+
+    executor = metrics.RunThreadPoolExecutor(max_workers=constants.WATCH_DOWNLOAD_CONCURRENCY)
+    # the polls have their own workers, so they don't wait behind the downloads
+    poll_executor = metrics.RunThreadPoolExecutor(max_workers=constants.WATCH_POLL_CONCURRENCY)
+    with progress.Progress('Downloading', total_files, total_size, log_path) as download_progress:
+        try:
+            while len(waiting_keys) > 0 or len(downloads) > 0:
+                start_ready_downloads()
+                for batch in __poll_batches(state_index, waiting_keys):
+                    with commons.catch_time() as batch_timer:
+                        poll_results = poll_executor.map(lambda key: __poll_restore_state(s3_client, state_index, key, download_progress), batch)
+                        for key, status in zip(batch, poll_results):
+                            if status == restore_state.STATUS_ARCHIVED:
+                                waiting_keys.discard(key)
+                                download_progress.failed(key.removeprefix(internal_prefix), 'not being restored anymore, it will not be downloaded')
+                    start_ready_downloads()
+                    collect_finished_downloads()
+                    # HEAD requests are sent in batches, and batches are spaced out to respect the request rate
+                    time.sleep(max(0.0, len(batch) / constants.WATCH_HEAD_REQUESTS_PER_SECOND - batch_timer()))
+                collect_finished_downloads()
+                if len(waiting_keys) > 0:
+                    download_progress.print(f'{len(waiting_keys)} objects are still being restored, {len(downloads)} downloads are in progress.'
+                                            f' Checking again at {time.ctime(time.time() + poll_interval)}.')
+                    __wait_for_next_poll(downloads, poll_interval, collect_finished_downloads)
+                elif len(downloads) > 0:
+                    concurrent.futures.wait(list(downloads))
+                    collect_finished_downloads()
+        except KeyboardInterrupt:
+            download_progress.print('Stopping the watch, downloads that have already started are finished first...')
+        finally:
+            poll_executor.shutdown(wait=True, cancel_futures=True)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    return download_progress.totals()
+
+
+def __poll_batches(state_index: restore_state.RestoreStateIndex, waiting_keys: set[str]) -> Iterator[list[str]]:
+    """
+    Select the objects worth checking: restorations that were requested recently can not be finished yet. The
+    oldest requests are checked first, those are the most likely to be finished.
+    """
+    now = time.time()
+    states = [state for state in map(state_index.lookup, waiting_keys) if state is not None]
+    poll_keys = [state.key for state in sorted(states, key=lambda state: state.requested_at)
+                 if state.status != restore_state.STATUS_PENDING or state.requested_at < now - constants.WATCH_FIRST_POLL_DELAY_SECONDS]
+    for start in range(0, len(poll_keys), constants.WATCH_HEAD_BATCH_SIZE):
+        yield poll_keys[start:start + constants.WATCH_HEAD_BATCH_SIZE]
+
+
+def __poll_restore_state(s3_client, state_index: restore_state.RestoreStateIndex, key: str, download_progress: progress.Progress) -> str:
+    try:
+        return restore_state.refresh_state(s3_client, state_index, key)
+    except botocore.client.ClientError as e:
+        # checked again at the next poll
+        download_progress.note(key, f'failed to check the status: {e.response["Error"]["Code"]}')
+        return restore_state.STATUS_PENDING
+
+
+def __wait_for_next_poll(downloads: dict, poll_interval: int, collect_finished_downloads):
+    deadline = time.time() + poll_interval
+    while (remaining := deadline - time.time()) > 0:
+        if len(downloads) > 0:
+            concurrent.futures.wait(list(downloads), timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect_finished_downloads()
+        else:
+            time.sleep(remaining)
+
+
+def __download_object(
+        item: tuple[str, int],
+        s3_client,
+        download_path: pathlib.Path,
+        internal_prefix: str,
+        download_progress: progress.Progress,
+        transfer_engine: commons.TransferEngine,
+        skip_existing: bool,
+        verify: bool
+) -> bool:
+    """
+    Download an object that stores a single file.
+    :return: False if the object could not be downloaded because it is not restored.
+    """
+    key, size = item
+    user_friendly_key = key.removeprefix(internal_prefix)
+    absolute_path = download_path.joinpath(user_friendly_key)
+    try:
+        if skip_existing and __is_already_downloaded(s3_client, key, size, absolute_path, verify):
+            download_progress.skipped(user_friendly_key, 'already downloaded', size)
+            return True
+        absolute_path.parent.mkdir(parents=True, exist_ok=True)
+        transfer_engine.download_object(s3_client, key, size, absolute_path)
+        download_progress.completed(user_friendly_key, size, 'downloaded')
+    except s3_client.exceptions.InvalidObjectState:
+        download_progress.deferred(user_friendly_key, 'NOT RESTORED, it cannot be downloaded')
+        __delete_empty_file(absolute_path)
+        return False
+    except botocore.client.ClientError as e:
+        download_progress.failed(user_friendly_key, f'failed to download: {e.response["Error"]["Code"]}', size, with_traceback=True)
+        __delete_empty_file(absolute_path)
+    except hashing.ContentHashMismatch:
+        download_progress.failed(user_friendly_key, 'CORRUPTED, it does not match the hash of the uploaded content', size)
+    return True
+
+
+def __download_index_entries_of_object(index_entries: list[archive_index.IndexEntry], *args) -> bool:
+    """
+    Download every file stored in the same object (bundle or deduplicated content).
+    :return: False if the object could not be downloaded because it is not restored.
+    """
+    return all([__download_index_entry(entry, *args) for entry in index_entries])
+
+
+def __download_index_entry(
+        entry: archive_index.IndexEntry,
+        s3_client,
+        download_path: pathlib.Path,
+        download_progress: progress.Progress,
+        transfer_engine: commons.TransferEngine,
+        skip_existing: bool,
+        verify: bool
+) -> bool:
+    """
+    Download a file that is not stored as its own object. Files packed into a bundle are
+    extracted by requesting only their byte range from the bundle.
+    :return: False if the file could not be downloaded because its object is not restored.
+    """
+    absolute_path = download_path.joinpath(entry.key)
+    try:
+        if skip_existing and __is_index_entry_already_downloaded(entry, absolute_path, verify):
+            download_progress.skipped(entry.key, 'already downloaded', entry.size)
+            return True
+        if entry.offset is None:
+            absolute_path.parent.mkdir(parents=True, exist_ok=True)
+            transfer_engine.download_object(s3_client, entry.object_key, entry.size, absolute_path)
+        else:
+            __extract_index_entry(s3_client, entry, absolute_path, transfer_engine)
+        download_progress.completed(entry.key, entry.size, 'downloaded')
+    except s3_client.exceptions.InvalidObjectState:
+        download_progress.deferred(entry.key, 'NOT RESTORED, it cannot be downloaded')
+        __delete_empty_file(absolute_path)
+        return False
+    except botocore.client.ClientError as e:
+        download_progress.failed(entry.key, f'failed to download: {e.response["Error"]["Code"]}', entry.size, with_traceback=True)
+        __delete_empty_file(absolute_path)
+    except hashing.ContentHashMismatch:
+        download_progress.failed(entry.key, 'CORRUPTED, it does not match the hash of the uploaded content', entry.size)
+    return True
+
+
+def __extract_index_entry(s3_client, entry: archive_index.IndexEntry, absolute_path: pathlib.Path, transfer_engine: commons.TransferEngine):
+    """
+    Download the byte range of a packed file from its bundle. The content is hashed while it is written, if the
+    index has its hash, a corrupted file is deleted and hashing.ContentHashMismatch is raised.
+    """
+    hasher = hashing.create_hasher(entry.content_hash) if entry.content_hash is not None else None
+    with __create_download_file_for_object(absolute_path) as download_file:
+        writer = download_file if hasher is None else hashing.HashingWriter(download_file, hasher)
+        if entry.size > 0:
+            response = s3_client.get_object(
+                Bucket=constants.ARCHIVE_BUCKET_NAME,
+                Key=entry.object_key,
+                Range=f'bytes={entry.offset}-{entry.offset + entry.size - 1}'
+            )
+            for chunk in transfer_engine.read_chunks(response):
+                writer.write(chunk)
+    if hasher is not None and hasher.hexdigest() != entry.content_hash:
+        absolute_path.unlink()
+        raise hashing.ContentHashMismatch(entry.key)
+
+
+def __skip_options(flags: dict) -> tuple[bool, bool]:
+    verify = bool(flags.get('verify', False))
+    return verify or bool(flags.get('skip-existing', False)), verify
+
+
+def __is_already_downloaded(s3_client, key: str, size: int, absolute_path: pathlib.Path, verify: bool) -> bool:
+    """
+    Compare an existing local file with the object. A file with the size of the listing is taken as downloaded
+    without a request: objects are only stored compressed if they became smaller, so the size of a compressed object
+    is never the size of its original. Otherwise the original size of compressed objects is found in the metadata,
+    along with the checksum of the content. Objects without a stored checksum can still be verified with their ETag,
+    if it is the MD5 hash of the content (single part, not compressed uploads).
+    """
+    if not absolute_path.is_file():
+        return False
+    if not verify and absolute_path.stat().st_size == size:
+        return True
+    response = s3_client.head_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+    metadata = response['Metadata']
+    compressed = compression.CODEC_METADATA_KEY in metadata
+    if compressed and compression.ORIGINAL_SIZE_METADATA_KEY not in metadata:
+        return False
+    expected_size = int(metadata[compression.ORIGINAL_SIZE_METADATA_KEY]) if compressed else response['ContentLength']
+    if absolute_path.stat().st_size != expected_size:
+        return False
+    if not verify:
+        return True
+    content_hash = hashing.content_hash_of_metadata(metadata)
+    if content_hash is not None:
+        return hashing.hash_file_like(str(absolute_path), content_hash) == content_hash
+    etag = response['ETag'].strip('"')
+    if not compressed and '-' not in etag:
+        return __md5_of_file(absolute_path) == etag
+    return False
+
+
+def __is_index_entry_already_downloaded(entry: archive_index.IndexEntry, absolute_path: pathlib.Path, verify: bool) -> bool:
+    """
+    Index entries know the size and the hash of the file. Entries saved before the hash was indexed are verified with
+    the name of the deduplicated content, packed files without a hash are downloaded again (they are small anyway).
+    """
+    if not absolute_path.is_file() or absolute_path.stat().st_size != entry.size:
+        return False
+    if not verify:
+        return True
+    if entry.content_hash is not None:
+        return hashing.hash_file_like(str(absolute_path), entry.content_hash) == entry.content_hash
+    if entry.offset is None:
+        content_hash = entry.object_key.rsplit('/', 1)[-1]
+        return hashing.hash_file_like(str(absolute_path), content_hash) == content_hash
+    return False
+
+
+def __md5_of_file(absolute_path: pathlib.Path) -> str:
+    digest = hashlib.md5()
+    with open(absolute_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(constants.HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def __create_download_folder_path(root: pathlib.Path) -> pathlib.Path:
@@ -119,15 +453,6 @@ def __create_download_file_for_object(absolute_path: pathlib.Path):
     return open(absolute_path, 'wb')
 
 
-def __update_progress(lock: threading.Lock, total_count: int) -> float:
-    global download_progress
-
-    with lock:
-        download_progress += 1
-
-    return round((download_progress/total_count)*100, 3)
-
-
 def __delete_empty_file(absolute_path: pathlib.Path):
     """
     Gets rid of leftover files that were not populated due to download errors
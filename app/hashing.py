@@ -0,0 +1,177 @@
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import Union
+
+import constants
+import metrics
+
+# the content hash is a tree hash: the SHA-256 of the concatenated SHA-256 digests of the fixed size chunks of
+# the content, so that the chunks of large files can be hashed in parallel, and the byte ranges of a download can
+# be verified independently of each other. The scheme is part of the hash, hashes without it are plain SHA-256.
+HASH_SCHEME = 'sha256tree'
+
+# uploaded objects carry the hash of their original content, so that downloads can be verified
+CONTENT_HASH_METADATA_KEY = 'content-hash'
+LEGACY_CONTENT_HASH_METADATA_KEY = 'sha256'
+
+process_pool = None
+process_pool_lock = threading.Lock()
+
+
+class ContentHashMismatch(Exception):
+    """
+    The downloaded content is not the same as the content that was uploaded.
+    """
+
+    def __init__(self, key: str):
+        super().__init__(f'The content of the object "{key}" does not match its content hash')
+        self.key = key
+
+
+class TreeHasher:
+    """
+    Calculates the tree hash of streamed content, in the same chunks as the parallel hashing of files.
+    """
+
+    def __init__(self):
+        self.__digests = []
+        self.__chunk = hashlib.sha256()
+        self.__chunk_length = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        while len(view) > 0:
+            taken = min(len(view), constants.HASH_CHUNK_SIZE - self.__chunk_length)
+            self.__chunk.update(view[:taken])
+            self.__chunk_length += taken
+            view = view[taken:]
+            if self.__chunk_length == constants.HASH_CHUNK_SIZE:
+                self.__digests.append(self.__chunk.digest())
+                self.__chunk = hashlib.sha256()
+                self.__chunk_length = 0
+
+    def chunk_digests(self) -> list[bytes]:
+        if self.__chunk_length > 0:
+            return self.__digests + [self.__chunk.digest()]
+        return list(self.__digests)
+
+    def hexdigest(self) -> str:
+        return combine_chunk_digests(self.chunk_digests())
+
+
+class LegacyHasher:
+    """
+    Plain SHA-256 of streamed content, to verify objects that were uploaded before the tree hash.
+    """
+
+    def __init__(self):
+        self.__digest = hashlib.sha256()
+
+    def update(self, data: bytes):
+        self.__digest.update(data)
+
+    def hexdigest(self) -> str:
+        return self.__digest.hexdigest()
+
+
+class HashingWriter:
+    """
+    File object wrapper that hashes the content while it is written, so that it doesn't have to be read again.
+    """
+
+    def __init__(self, fileobj, hasher: Union[TreeHasher, LegacyHasher]):
+        self.__fileobj = fileobj
+        self.__hasher = hasher
+
+    def write(self, data: bytes) -> int:
+        self.__hasher.update(data)
+        return self.__fileobj.write(data)
+
+
+def combine_chunk_digests(chunk_digests: list[bytes]) -> str:
+    return f'{HASH_SCHEME}-{hashlib.sha256(b"".join(chunk_digests)).hexdigest()}'
+
+
+def is_legacy_hash(content_hash: str) -> bool:
+    return not content_hash.startswith(f'{HASH_SCHEME}-')
+
+
+def hash_file(path: str) -> str:
+    """
+    Calculate the tree hash of the file's content. Large files are split into segments that are hashed in
+    parallel by a process pool, every process reads its segment through a memory map.
+    """
+    start = time.perf_counter()
+    size = os.path.getsize(path)
+    if size < constants.HASH_PARALLEL_THRESHOLD:
+        chunk_digests = __hash_segment(path, 0, size)
+    else:
+        offsets = range(0, size, constants.HASH_SEGMENT_SIZE)
+        lengths = [min(constants.HASH_SEGMENT_SIZE, size - offset) for offset in offsets]
+        segment_digests = __get_process_pool().map(__hash_segment, repeat(path), offsets, lengths)
+        chunk_digests = [digest for digests in segment_digests for digest in digests]
+    metrics.count('hashed_bytes', size)
+    metrics.count('hash_seconds', time.perf_counter() - start)
+    return combine_chunk_digests(chunk_digests)
+
+
+def hash_file_like(path: str, reference_hash: str) -> str:
+    """
+    Calculate the hash of the file's content with the same scheme as the reference hash, so that they can be compared.
+    """
+    if is_legacy_hash(reference_hash):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(constants.HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    return hash_file(path)
+
+
+def hash_content(content: bytes) -> str:
+    """
+    Calculate the tree hash of content that is already in memory.
+    """
+    hasher = TreeHasher()
+    hasher.update(content)
+    return hasher.hexdigest()
+
+
+def content_hash_of_metadata(metadata: dict) -> Union[str, None]:
+    if CONTENT_HASH_METADATA_KEY in metadata:
+        return metadata[CONTENT_HASH_METADATA_KEY]
+    return metadata.get(LEGACY_CONTENT_HASH_METADATA_KEY)
+
+
+def create_hasher(content_hash: str) -> Union[TreeHasher, LegacyHasher]:
+    return LegacyHasher() if is_legacy_hash(content_hash) else TreeHasher()
+
+
+def __get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+    with process_pool_lock:
+        if process_pool is None:
+            process_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+        return process_pool
+
+
+def __hash_segment(path: str, offset: int, length: int) -> list[bytes]:
+    """
+    Hash the chunks of a segment of the file. The offset must be a multiple of the chunk size, which
+    is also a multiple of the memory map granularity of every platform.
+    """
+    if length == 0:
+        return []
+    try:
+        with open(path, 'rb') as file, mmap.mmap(file.fileno(), length, offset=offset, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                return [hashlib.sha256(view[start:start + constants.HASH_CHUNK_SIZE]).digest()
+                        for start in range(0, length, constants.HASH_CHUNK_SIZE)]
+    except ValueError:
+        # the file became shorter than the mapped length
+        raise OSError(f'The file "{path}" has changed while it was hashed')
@@ -6,3 +6,8 @@ def process_help_command(email: str):
     print(f'Source code and documentation {constants.SOURCE_DOCS_URL}')
     print('Your files in the archive are stored deep in the AWS cloud! To download them, they must first be restored. '
           'Restoring has a cost associated, so it must be done sparsely: this is not a file viewer application.')
+    print('The root folder is not scanned at startup, use "root_summary" to see how many files it contains.')
+    print('Use "restore_status [path] --refresh" to check which restored objects are ready for download.')
+    print('Use "watch_and_download [path]" to download the objects as soon as their restoration finishes.')
+    print('A metrics report of every command is saved into the "metrics" folder. Add "--profile" to a command to also profile it.')
+    print('Add "--log=<file>" to the archive, restore and download commands to log the outcome of every file.')
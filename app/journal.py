@@ -0,0 +1,194 @@
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Union
+
+import constants
+
+
+class JournalUpload:
+    """
+    A multipart upload that was started, but not yet completed or aborted. Uploads of files know the
+    file they belong to, so they can be resumed. Uploads of streamed content (bundles) can only be aborted.
+    """
+
+    def __init__(self, key: str, upload_id: str, size: Union[int, None], content_hash: Union[str, None],
+                 part_size: int, started_at: float):
+        self.key = key
+        self.upload_id = upload_id
+        self.size = size
+        self.content_hash = content_hash
+        self.part_size = part_size
+        self.started_at = started_at
+        self.parts = dict()
+
+    def is_resumable(self) -> bool:
+        return self.content_hash is not None
+
+    def to_json(self) -> dict:
+        return {
+            'op': 'upload',
+            'key': self.key,
+            'upload_id': self.upload_id,
+            'size': self.size,
+            'content_hash': self.content_hash,
+            'part_size': self.part_size,
+            'started_at': self.started_at
+        }
+
+
+class ArchiveJournal:
+    """
+    Append-only log of the progress of the archive command, placed inside the root folder next to the catalog.
+    It records the archived files (the catalog commits them in batches, the journal keeps them if the program
+    is killed in between), the multipart uploads in flight and their completed parts. The records are buffered,
+    and written by a background thread in groups, so the uploads never wait for the disk.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.path = root.joinpath(constants.JOURNAL_FILE_NAME)
+        self.completed_files: list[tuple[str, int, int, str]] = []
+        self.uploads: dict[str, JournalUpload] = dict()
+        torn_last_line = self.__replay()
+        self.__buffer = []
+        self.__appended_count = 0
+        self.__written_count = 0
+        self.__flush_requested = False
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__write_error: Union[Exception, None] = None
+        self.__file = open(self.path, 'a', encoding='utf-8')
+        if torn_last_line:
+            # the next record must start on a new line
+            self.__file.write('\n')
+        self.__writer = threading.Thread(target=self.__write_batches, daemon=True)
+        self.__writer.start()
+
+    def record_file(self, key: str, size: int, mtime_ns: int, content_hash: str):
+        self.__append({'op': 'file', 'key': key, 'size': size, 'mtime_ns': mtime_ns, 'content_hash': content_hash})
+
+    def record_upload_started(self, key: str, upload_id: str, part_size: int, size: int = None, content_hash: str = None):
+        """
+        Written to the disk before returning: an upload that is missing from the journal would never be aborted.
+        """
+        upload = JournalUpload(key, upload_id, size, content_hash, part_size, time.time())
+        with self.__condition:
+            self.uploads[upload_id] = upload
+        self.__append(upload.to_json(), wait=True)
+
+    def record_part(self, upload_id: str, part_number: int, etag: str):
+        with self.__condition:
+            self.uploads[upload_id].parts[part_number] = etag
+        self.__append({'op': 'part', 'upload_id': upload_id, 'part_number': part_number, 'etag': etag})
+
+    def record_upload_finished(self, upload_id: str):
+        """
+        The upload was completed or aborted.
+        """
+        with self.__condition:
+            self.uploads.pop(upload_id, None)
+        self.__append({'op': 'done', 'upload_id': upload_id})
+
+    def in_flight_uploads(self) -> list[JournalUpload]:
+        with self.__condition:
+            return list(self.uploads.values())
+
+    def upload_of(self, key: str) -> Union[JournalUpload, None]:
+        with self.__condition:
+            return next((upload for upload in self.uploads.values() if upload.key == key and upload.is_resumable()), None)
+
+    def close(self, compact: bool):
+        """
+        :param compact: Rewrite the journal with only the uploads in flight. Only allowed once the
+        archived files are committed into the catalog.
+        """
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__writer.join()
+        self.__file.close()
+        self.__raise_write_error()
+        if compact:
+            temporary_path = self.path.with_name(self.path.name + '.tmp')
+            with open(temporary_path, 'w', encoding='utf-8') as journal_file:
+                for upload in self.uploads.values():
+                    journal_file.write(json.dumps(upload.to_json()) + '\n')
+                    for part_number, etag in upload.parts.items():
+                        journal_file.write(json.dumps({'op': 'part', 'upload_id': upload.upload_id, 'part_number': part_number, 'etag': etag}) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            os.replace(temporary_path, self.path)
+
+    def __append(self, record: dict, wait: bool = False):
+        with self.__condition:
+            self.__raise_write_error()
+            self.__buffer.append(json.dumps(record) + '\n')
+            self.__appended_count += 1
+            record_number = self.__appended_count
+            if wait:
+                self.__flush_requested = True
+            if wait or len(self.__buffer) >= constants.JOURNAL_MAX_BUFFERED_RECORDS:
+                self.__condition.notify_all()
+            if wait:
+                self.__condition.wait_for(lambda: self.__written_count >= record_number or self.__write_error is not None)
+                self.__raise_write_error()
+
+    def __write_batches(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda: self.__closed or self.__flush_requested or len(self.__buffer) >= constants.JOURNAL_MAX_BUFFERED_RECORDS,
+                    timeout=constants.JOURNAL_FLUSH_INTERVAL_SECONDS
+                )
+                lines = self.__buffer
+                self.__buffer = []
+                self.__flush_requested = False
+                batch_end = self.__appended_count
+                closed = self.__closed
+            try:
+                if len(lines) > 0:
+                    self.__file.write(''.join(lines))
+                    self.__file.flush()
+                    os.fsync(self.__file.fileno())
+            except Exception as e:
+                # the waiting uploads are woken up, they fail with the error instead of waiting forever
+                with self.__condition:
+                    self.__write_error = e
+                    self.__condition.notify_all()
+                return
+            with self.__condition:
+                self.__written_count = batch_end
+                self.__condition.notify_all()
+            if closed:
+                return
+
+    def __raise_write_error(self):
+        if self.__write_error is not None:
+            raise OSError(f'The journal "{self.path}" could not be written: {self.__write_error}') from self.__write_error
+
+    def __replay(self) -> bool:
+        """
+        Rebuild the state from the records. The last line may be incomplete, if the program was killed while writing it.
+        :return: True if the last line is incomplete.
+        """
+        if not self.path.exists():
+            return False
+        line = '\n'
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record['op'] == 'file':
+                    self.completed_files.append((record['key'], record['size'], record['mtime_ns'], record['content_hash']))
+                elif record['op'] == 'upload':
+                    self.uploads[record['upload_id']] = JournalUpload(record['key'], record['upload_id'], record['size'],
+                                                                      record['content_hash'], record['part_size'], record['started_at'])
+                elif record['op'] == 'part' and record['upload_id'] in self.uploads:
+                    self.uploads[record['upload_id']].parts[record['part_number']] = record['etag']
+                elif record['op'] == 'done':
+                    self.uploads.pop(record['upload_id'], None)
+        return not line.endswith('\n')
@@ -1,19 +1,27 @@
-import multiprocessing
 import time
 
 import boto3
 
+import archive_index
 import constants
 import commons
+import metrics
 
 
-def process_list_archive_command(aws_session: boto3.Session, user_id: str, command_data: str):
+def process_list_archive_command(aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
+    """
+    List the folders and files directly under the prefix.
+    :param flags: With "--depth=N", the contents of the folders are listed too, up to N levels deep.
+    """
+    depth = int(flags.get('depth', 1))
+    if depth < 1:
+        raise Exception('Depth of the listing must be at least 1')
     with commons.catch_time() as list_timer:
-        __process_list_command(aws_session, user_id, command_data)
+        __process_list_command(aws_session, user_id, command_data, depth)
     print(f'Listing finished at {time.ctime()} and took {list_timer():.4f} seconds')
 
 
-def __process_list_command(aws_session: boto3.Session, user_id: str, command_data: str):
+def __process_list_command(aws_session: boto3.Session, user_id: str, command_data: str, depth: int):
     if command_data != 'root' and not command_data.endswith('/'):
         raise Exception('Prefix must end with / character or be "root"')
 
@@ -21,59 +29,52 @@ def __process_list_command(aws_session: boto3.Session, user_id: str, command_dat
     print(f'Listing your archived contents under "{command_data}", this might take some time...')
     full_prefix, internal_prefix = commons.create_prefix_with_user_id(user_id, command_data)
 
-    paginator = s3_client.get_paginator('list_objects_v2')
-    pages = paginator.paginate(
-        Bucket=constants.ARCHIVE_BUCKET_NAME,
-        Prefix=full_prefix,
-        PaginationConfig={
-            'PageSize': constants.MAX_PAGE_SIZE
-        }
-    )
-
-    args = []
-    for page in pages:
-        args.append((full_prefix, page))
-
-    thread_pool = multiprocessing.pool.ThreadPool(processes=constants.THREADS)
-    results_per_page = thread_pool.starmap(__process_page, args)
+    # every level is listed with a delimiter, so only the direct children of each folder are returned
+    results = set()
+    folder_prefixes = [full_prefix]
+    thread_pool = metrics.run_thread_pool(constants.THREADS)
+    for _ in range(depth):
+        listings = thread_pool.starmap(__list_direct_children, [(s3_client, prefix) for prefix in folder_prefixes])
+        folder_prefixes = []
+        for folders, files in listings:
+            results.update(key.removeprefix(full_prefix) for key in folders + files)
+            folder_prefixes.extend(folders)
+        if len(folder_prefixes) == 0:
+            break
     thread_pool.close()
     thread_pool.join()
 
-    results = __aggregate_results(results_per_page)
+    # files that are packed into bundles or deduplicated are only found in the index
+    index = archive_index.load_archive_index(s3_client, user_id)
+    relative_prefix = full_prefix.removeprefix(internal_prefix)
+    for entry in index.entries_with_prefix(relative_prefix):
+        __add_index_entry(results, entry.key.removeprefix(relative_prefix), depth)
 
     if len(results) > 0:
         print(f'Found the following folders and files under this folder:\n')
-        for result in results:
+        for result in sorted(results):
             print(result)
         print('\nPlease note that these may be archived, restored or under restoration right now.')
     else:
         print('Found nothing under the selected prefix in your archive. Try with "list_archive root" to see your folders.')
 
 
-def __aggregate_results(results_per_page):
-    aggregated_results = set()
-    for result_of_page in results_per_page:
-        aggregated_results = aggregated_results.union(result_of_page)
-    return aggregated_results
-
-
-def __process_page(full_prefix: str, page):
-    results = set()
-    if 'Contents' in page:
-        for obj in page['Contents']:
-            key = obj['Key']
-            __process_object(results, full_prefix, key)
-    return results
-
-
-def __process_object(results: set[str], full_prefix: str, full_key: str):
-    prefix_of_interest = full_key.removeprefix(full_prefix)
-
-    # is this object in a "folder"?
-    if '/' in prefix_of_interest:
-        folder = prefix_of_interest.split('/')[0]
-        results.add(f'{folder}/')
-    else:
-        results.add(prefix_of_interest)
-
-
+def __list_direct_children(s3_client, prefix: str) -> tuple[list[str], list[str]]:
+    """
+    :return: The keys of the folders and files directly under the prefix. Internal folders are left out.
+    """
+    folders, objects = commons.list_direct_children(s3_client, prefix)
+    folders = [folder for folder in folders if not commons.is_internal_key(folder)]
+    files = [obj['Key'] for obj in objects if not commons.is_internal_key(obj['Key'])]
+    return folders, files
+
+
+def __add_index_entry(results: set[str], relative_key: str, depth: int):
+    """
+    Add the file to the results if it is within the depth, and the folders leading to it otherwise.
+    """
+    segments = relative_key.split('/')
+    for level in range(1, min(depth, len(segments) - 1) + 1):
+        results.add('/'.join(segments[:level]) + '/')
+    if len(segments) <= depth:
+        results.add(relative_key)
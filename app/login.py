@@ -1,3 +1,5 @@
+import functools
+
 import boto3
 from botocore.exceptions import ClientError
 from typing import Union
@@ -8,8 +10,16 @@ import json
 
 import constants
 
-cognito_user_client = boto3.client('cognito-idp', constants.AWS_REGION)
-cognito_identity_client = boto3.client('cognito-identity', constants.AWS_REGION)
+
+# clients are created on first use: a cached session starts without contacting Cognito at all
+@functools.cache
+def cognito_user_client():
+    return boto3.client('cognito-idp', constants.AWS_REGION)
+
+
+@functools.cache
+def cognito_identity_client():
+    return boto3.client('cognito-identity', constants.AWS_REGION)
 
 
 def obtain_user_credentials():
@@ -27,10 +37,11 @@ def obtain_user_credentials():
 
 class UserData:
 
-    def __init__(self, email, access_token, id_token):
+    def __init__(self, email, access_token, id_token, refresh_token):
         self.email = email
         self.access_token = access_token
         self.id_token = id_token
+        self.refresh_token = refresh_token
         self.user_id = None
 
     def set_user_id(self, user_id):
@@ -39,7 +50,7 @@ class UserData:
 
 def log_in(username: str, password: str) -> Union[UserData, None]:
     try:
-        sign_in_response = cognito_user_client.initiate_auth(
+        sign_in_response = cognito_user_client().initiate_auth(
             AuthFlow='USER_PASSWORD_AUTH',
             AuthParameters={
                 'USERNAME': username,
@@ -64,12 +75,13 @@ def log_in(username: str, password: str) -> Union[UserData, None]:
         return UserData(
             email=username,
             access_token=sign_in_response['AuthenticationResult']['AccessToken'],
-            id_token=sign_in_response['AuthenticationResult']['IdToken']
+            id_token=sign_in_response['AuthenticationResult']['IdToken'],
+            refresh_token=sign_in_response['AuthenticationResult']['RefreshToken']
         )
 
 
 def change_temporary_password(username: str, new_password: str, session: str) -> UserData:
-    change_password_response = cognito_user_client.respond_to_auth_challenge(
+    change_password_response = cognito_user_client().respond_to_auth_challenge(
         ClientId=constants.COGNITO_USER_POOL_CLIENT_ID,
         Session=session,
         ChallengeName='NEW_PASSWORD_REQUIRED',
@@ -81,12 +93,27 @@ def change_temporary_password(username: str, new_password: str, session: str) ->
     return UserData(
         email=username,
         access_token=change_password_response['AuthenticationResult']['AccessToken'],
-        id_token=change_password_response['AuthenticationResult']['IdToken']
+        id_token=change_password_response['AuthenticationResult']['IdToken'],
+        refresh_token=change_password_response['AuthenticationResult']['RefreshToken']
+    )
+
+
+def refresh_id_token(refresh_token: str) -> str:
+    """
+    Obtain a new ID token with the refresh token, without the password of the user.
+    """
+    refresh_response = cognito_user_client().initiate_auth(
+        AuthFlow='REFRESH_TOKEN_AUTH',
+        AuthParameters={
+            'REFRESH_TOKEN': refresh_token
+        },
+        ClientId=constants.COGNITO_USER_POOL_CLIENT_ID
     )
+    return refresh_response['AuthenticationResult']['IdToken']
 
 
 def get_cognito_identity_id(token: str) -> str:
-    response = cognito_identity_client.get_id(
+    response = cognito_identity_client().get_id(
         AccountId=constants.AWS_ACCOUNT_ID,
         IdentityPoolId=constants.COGNITO_IDENTITY_POOL_ID,
         Logins={
@@ -96,20 +123,26 @@ def get_cognito_identity_id(token: str) -> str:
     return response['IdentityId']
 
 
-def exchange_token_for_aws_credentials(cognito_identity_id: str, token: str):
-    response = cognito_identity_client.get_credentials_for_identity(
+def exchange_token_for_aws_credentials(cognito_identity_id: str, token: str) -> dict:
+    """
+    :return: The temporary credentials, in the format of the refreshable credentials of botocore.
+    """
+    response = cognito_identity_client().get_credentials_for_identity(
         IdentityId=cognito_identity_id,
         Logins={
             f'cognito-idp.{constants.AWS_REGION}.amazonaws.com/{constants.COGNITO_USER_POOL_ID}': token
         }
     )
-    return response['Credentials']['AccessKeyId'],\
-        response['Credentials']['SecretKey'], \
-        response['Credentials']['SessionToken']
+    return {
+        'access_key': response['Credentials']['AccessKeyId'],
+        'secret_key': response['Credentials']['SecretKey'],
+        'token': response['Credentials']['SessionToken'],
+        'expiry_time': response['Credentials']['Expiration'].isoformat()
+    }
 
 
 def get_user_id(access_token: str) -> str:
-    response = cognito_user_client.get_user(AccessToken=access_token)
+    response = cognito_user_client().get_user(AccessToken=access_token)
     for attribute in response['UserAttributes']:
         if attribute['Name'] == 'sub':
             return attribute['Value']
@@ -1,7 +1,7 @@
 import json
 import traceback
+from contextlib import nullcontext
 
-import boto3
 import pathlib
 import os.path as path
 
@@ -11,32 +11,37 @@ import list_command
 import archive_command
 import restore_command
 import download_command
-import constants
-from commons import extract_command_arguments, get_files_data, extract_quoted_argument
+import user_session
+import metrics
+from commons import extract_command_arguments, get_files_data, extract_quoted_argument, validate_root_folder, catch_time, \
+    extract_command_flags
 
+# commands that work with the archive, the metrics of each run are saved into a report
+measured_commands = {'root_summary', 'list_archive', 'archive_data', 'restore_data', 'restore_status', 'download_data', 'watch_and_download'}
 
 if __name__ == '__main__':
-    # login flow
-    print('Sign in to access your archive!')
-    username, password = login.obtain_user_credentials()
-    user_data = login.log_in(username=username, password=password)
-    if user_data is not None:
-        cognito_identity_id = login.get_cognito_identity_id(user_data.id_token)
-        user_data.set_user_id(cognito_identity_id)
-        print(f'Login successful, your user ID is {user_data.user_id}')
-
-        access_key_id, secret_key, session_token = login.exchange_token_for_aws_credentials(cognito_identity_id, user_data.id_token)
-        print('Temporary AWS credentials have been obtained!')
+    # login flow, skipped if the session of the previous run can be continued
+    current_session = user_session.resume_session()
+    if current_session is not None:
+        print(f'Continuing your previous session, your user ID is {current_session.user_id}')
     else:
-        print('The authentication was unsuccessful, aborting...')
-        exit(1)
+        print('Sign in to access your archive!')
+        username, password = login.obtain_user_credentials()
+        user_data = login.log_in(username=username, password=password)
+        if user_data is not None:
+            cognito_identity_id = login.get_cognito_identity_id(user_data.id_token)
+            user_data.set_user_id(cognito_identity_id)
+            print(f'Login successful, your user ID is {user_data.user_id}')
+
+            credentials = login.exchange_token_for_aws_credentials(cognito_identity_id, user_data.id_token)
+            print('Temporary AWS credentials have been obtained!')
+        else:
+            print('The authentication was unsuccessful, aborting...')
+            exit(1)
+        current_session = user_session.UserSession(user_data.email, user_data.user_id, user_data.refresh_token, credentials)
+        user_session.save_session(current_session)
 
-    aws_session = boto3.Session(
-        aws_access_key_id=access_key_id,
-        aws_secret_access_key=secret_key,
-        aws_session_token=session_token,
-        region_name=constants.AWS_REGION
-    )
+    aws_session = user_session.create_aws_session(current_session)
 
     # getting path to the archive root on this machine
     if path.isfile('paths.json'):
@@ -47,26 +52,36 @@ if __name__ == '__main__':
     else:
         root_directory = input(f'Provide the root directory of your archive, such as "C:/data/archive"')
     root_directory_path = pathlib.Path(root_directory)
-    root_data = get_files_data(root_directory_path, root_directory_path)
-    print(f'The root directory contains a total of {root_data.file_count} files with a total size of {root_data.total_size_gb()} GBs')
+    validate_root_folder(root_directory_path)
 
     # command processing flow
     command = 'help'
     while command != 'exit':
         print("\n\n")
         try:
-            if command == 'help':
-                help_command.process_help_command(user_data.email)
-            elif command.startswith('list_archive '):
-                list_command.process_list_archive_command(aws_session, user_data.user_id, extract_command_arguments(command))
-            elif command.startswith('archive_data '):
-                archive_command.process_archive_command(root_directory_path, aws_session, user_data.user_id, extract_quoted_argument(command))
-            elif command.startswith('restore_data '):
-                restore_command.process_restore_command(aws_session, user_data.user_id, extract_command_arguments(command))
-            elif command.startswith('download_data '):
-                download_command.process_download_command(root_directory_path, aws_session, user_data.user_id, extract_command_arguments(command))
-            else:
-                print('Error: this command is unknown')
+            command_name = command.split(sep=' ')[0]
+            with metrics.measuring(command_name, extract_command_flags(command)) if command_name in measured_commands else nullcontext():
+                if command == 'help':
+                    help_command.process_help_command(current_session.email)
+                elif command == 'root_summary':
+                    with catch_time() as summary_timer:
+                        root_data = get_files_data(root_directory_path, root_directory_path, keep_files=False)
+                    print(f'The root directory contains a total of {root_data.file_count} files with a total size of {root_data.total_size_gb()} GBs'
+                          f' (scanned in {summary_timer():.4f} seconds)')
+                elif command.startswith('list_archive '):
+                    list_command.process_list_archive_command(aws_session, current_session.user_id, extract_command_arguments(command), extract_command_flags(command))
+                elif command.startswith('archive_data '):
+                    archive_command.process_archive_command(root_directory_path, aws_session, current_session.user_id, extract_quoted_argument(command), extract_command_flags(command))
+                elif command.startswith('restore_data '):
+                    restore_command.process_restore_command(root_directory_path, aws_session, current_session.user_id, extract_command_arguments(command), extract_command_flags(command))
+                elif command.startswith('restore_status '):
+                    restore_command.process_restore_status_command(root_directory_path, aws_session, current_session.user_id, extract_command_arguments(command), extract_command_flags(command))
+                elif command.startswith('download_data '):
+                    download_command.process_download_command(root_directory_path, aws_session, current_session.user_id, extract_command_arguments(command), extract_command_flags(command))
+                elif command.startswith('watch_and_download '):
+                    download_command.process_watch_and_download_command(root_directory_path, aws_session, current_session.user_id, extract_command_arguments(command), extract_command_flags(command))
+                else:
+                    print('Error: this command is unknown')
         except BaseException as e:
             print('An error prevented your command from running. You may have used an invalid command.')
             traceback.print_exc()
@@ -0,0 +1,396 @@
+import cProfile
+import contextvars
+import datetime
+import io
+import json
+import multiprocessing.pool
+import os
+import pathlib
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from typing import Union
+
+import constants
+
+# the metrics of the command that is running in this context, the instrumented code reports to it through the module
+# functions. The worker threads of a command join its run when they start, see RunThreadPoolExecutor.
+current_run: contextvars.ContextVar[Union['RunMetrics', None]] = contextvars.ContextVar('current_run', default=None)
+
+
+class Histogram:
+    """
+    Counts of the observed values in fixed buckets, the quantiles are estimated with the upper bounds of the buckets.
+    """
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.bucket_counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        bucket = next((index for index, bound in enumerate(self.bounds) if value <= bound), len(self.bounds))
+        self.bucket_counts[bucket] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'Histogram'):
+        self.bucket_counts = [count + other_count for count, other_count in zip(self.bucket_counts, other.bucket_counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, quantile: float) -> float:
+        cumulative_count = 0
+        for index, count in enumerate(self.bucket_counts):
+            cumulative_count += count
+            if cumulative_count >= quantile * self.count:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return self.max
+
+    def to_json(self) -> dict:
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count > 0 else 0.0,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+            'buckets': {str(bound): count for bound, count in zip(list(self.bounds) + ['+Inf'], self.bucket_counts)}
+        }
+
+
+class Samples:
+    """
+    Values sampled over the run, such as the number of operations in flight.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count > 0 else 0.0
+
+
+class RunMetrics:
+    """
+    Measurements of one command: counters, latency histograms and samples, each with an optional label, such as
+    the S3 operation or the name of the worker pool. S3 requests are measured through the events of botocore.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started_at = time.time()
+        self.finished_at = None
+        self.profile_files = dict()
+        self.__lock = threading.Lock()
+        self.__counters: dict[tuple[str, str], float] = dict()
+        self.__histograms: dict[tuple[str, str], Histogram] = dict()
+        self.__samples: dict[tuple[str, str], Samples] = dict()
+
+    def count(self, name: str, amount: float = 1, label: str = ''):
+        with self.__lock:
+            self.__counters[(name, label)] = self.__counters.get((name, label), 0) + amount
+
+    def observe(self, name: str, value: float, label: str = ''):
+        with self.__lock:
+            if (name, label) not in self.__histograms:
+                self.__histograms[(name, label)] = Histogram(constants.METRICS_LATENCY_BUCKETS)
+            self.__histograms[(name, label)].observe(value)
+
+    def sample(self, name: str, value: float, label: str = ''):
+        with self.__lock:
+            self.__samples.setdefault((name, label), Samples()).add(value)
+
+    def duration(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def counter_total(self, name: str) -> float:
+        with self.__lock:
+            return sum(value for (counter_name, _), value in self.__counters.items() if counter_name == name)
+
+    def merged_histogram(self, name: str) -> Histogram:
+        merged = Histogram(constants.METRICS_LATENCY_BUCKETS)
+        with self.__lock:
+            for (histogram_name, _), histogram in self.__histograms.items():
+                if histogram_name == name:
+                    merged.merge(histogram)
+        return merged
+
+    def worker_utilization(self) -> dict[str, float]:
+        """
+        How busy the worker pools were: the average operations in flight compared to the average limit.
+        """
+        with self.__lock:
+            return {label: samples.mean() / self.__samples[('concurrency_limit', label)].mean()
+                    for (name, label), samples in self.__samples.items()
+                    if name == 'in_flight' and ('concurrency_limit', label) in self.__samples}
+
+    def report(self) -> dict:
+        duration = self.duration()
+        with self.__lock:
+            counters = dict()
+            for (name, label), value in self.__counters.items():
+                counters.setdefault(name, dict())[label or 'total'] = value
+            histograms = dict()
+            for (name, label), histogram in self.__histograms.items():
+                histograms.setdefault(name, dict())[label or 'total'] = histogram.to_json()
+            samples = dict()
+            for (name, label), sampled in self.__samples.items():
+                samples.setdefault(name, dict())[label or 'total'] = {'mean': sampled.mean(), 'max': sampled.max}
+        hash_seconds = self.counter_total('hash_seconds')
+        return {
+            'command': self.command,
+            'started_at': datetime.datetime.fromtimestamp(self.started_at).isoformat(),
+            'duration_seconds': duration,
+            'summary': {
+                's3_requests': self.counter_total('s3_requests'),
+                's3_errors': self.counter_total('s3_errors'),
+                's3_retries': self.counter_total('s3_retries'),
+                's3_throttles': self.counter_total('s3_throttles'),
+                'transferred_bytes_per_second': self.counter_total('transferred_bytes') / duration if duration > 0 else 0.0,
+                'hashed_bytes_per_second': self.counter_total('hashed_bytes') / hash_seconds if hash_seconds > 0 else 0.0,
+                'bandwidth_wait_seconds': self.counter_total('bandwidth_wait_seconds'),
+                'budget_wait_seconds': self.counter_total('budget_wait_seconds'),
+                'worker_utilization': self.worker_utilization()
+            },
+            'counters': counters,
+            'histograms': histograms,
+            'samples': samples,
+            'profile': self.profile_files
+        }
+
+    def write_report(self, report_path: pathlib.Path):
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+    def write_prometheus_textfile(self, textfile_path: pathlib.Path):
+        """
+        Write the metrics in the text format of Prometheus, to be collected by the textfile collector of the node
+        exporter. The file is replaced at once, so the collector never reads a half written file.
+        """
+        command_label = f'command="{self.command}"'
+        lines = [
+            '# TYPE deep_archive_run_duration_seconds gauge',
+            f'deep_archive_run_duration_seconds{{{command_label}}} {self.duration()}',
+            '# TYPE deep_archive_run_finished_timestamp_seconds gauge',
+            f'deep_archive_run_finished_timestamp_seconds{{{command_label}}} {self.finished_at or time.time()}'
+        ]
+        with self.__lock:
+            for name in sorted({name for name, _ in self.__counters}):
+                lines.append(f'# TYPE deep_archive_{name}_total counter')
+                for (counter_name, label), value in sorted(self.__counters.items()):
+                    if counter_name == name:
+                        lines.append(f'deep_archive_{name}_total{{{self.__prometheus_labels(command_label, name, label)}}} {value}')
+            for name in sorted({name for name, _ in self.__histograms}):
+                lines.append(f'# TYPE deep_archive_{name} histogram')
+                for (histogram_name, label), histogram in sorted(self.__histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    labels = self.__prometheus_labels(command_label, name, label)
+                    cumulative_count = 0
+                    for bound, count in zip(list(histogram.bounds) + ['+Inf'], histogram.bucket_counts):
+                        cumulative_count += count
+                        lines.append(f'deep_archive_{name}_bucket{{{labels},le="{bound}"}} {cumulative_count}')
+                    lines.append(f'deep_archive_{name}_sum{{{labels}}} {histogram.sum}')
+                    lines.append(f'deep_archive_{name}_count{{{labels}}} {histogram.count}')
+            for name in sorted({name for name, _ in self.__samples}):
+                lines.append(f'# TYPE deep_archive_{name}_mean gauge')
+                for (samples_name, label), sampled in sorted(self.__samples.items()):
+                    if samples_name == name:
+                        lines.append(f'deep_archive_{name}_mean{{{self.__prometheus_labels(command_label, name, label)}}} {sampled.mean()}')
+        temporary_path = textfile_path.with_name(textfile_path.name + '.tmp')
+        with open(temporary_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(temporary_path, textfile_path)
+
+    @staticmethod
+    def __prometheus_labels(command_label: str, name: str, label: str) -> str:
+        if label == '':
+            return command_label
+        label_name = 'operation' if name.startswith('s3_') else 'pool'
+        return f'{command_label},{label_name}="{label}"'
+
+    def print_summary(self):
+        summary = self.report()['summary']
+        latency = self.merged_histogram('s3_request_seconds')
+        print(f'Metrics of the run: {summary["s3_requests"]:.0f} S3 requests (p50 {latency.quantile(0.5) * 1000:.0f} ms, '
+              f'p99 {latency.quantile(0.99) * 1000:.0f} ms), {summary["s3_retries"]:.0f} retried, {summary["s3_throttles"]:.0f} throttled, '
+              f'{summary["transferred_bytes_per_second"] / (1024*1024):.2f} MB/s transferred.')
+        if summary['bandwidth_wait_seconds'] > 0 or summary['budget_wait_seconds'] > 0:
+            print(f'Waited {summary["bandwidth_wait_seconds"]:.1f} seconds for the bandwidth limit, and '
+                  f'{summary["budget_wait_seconds"]:.1f} seconds for the in flight bytes budget.')
+        if summary['hashed_bytes_per_second'] > 0:
+            print(f'Hashing a file ran at {summary["hashed_bytes_per_second"] / (1024*1024):.1f} MB/s on average.')
+        for pool, utilization in summary['worker_utilization'].items():
+            print(f'The {pool} workers were {utilization * 100:.0f}% busy.')
+
+
+def count(name: str, amount: float = 1, label: str = ''):
+    run = current_run.get()
+    if run is not None:
+        run.count(name, amount, label)
+
+
+def observe(name: str, value: float, label: str = ''):
+    run = current_run.get()
+    if run is not None:
+        run.observe(name, value, label)
+
+
+def sample(name: str, value: float, label: str = ''):
+    run = current_run.get()
+    if run is not None:
+        run.sample(name, value, label)
+
+
+class RunThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    Thread pool whose workers report to the run of the thread that created the pool.
+    """
+
+    def __init__(self, max_workers: int = None, thread_name_prefix: str = ''):
+        super().__init__(max_workers, thread_name_prefix, initializer=current_run.set, initargs=(current_run.get(),))
+
+
+def run_thread_pool(processes: int) -> multiprocessing.pool.ThreadPool:
+    """
+    The same for the thread pools of multiprocessing.
+    """
+    return multiprocessing.pool.ThreadPool(processes=processes, initializer=current_run.set, initargs=(current_run.get(),))
+
+
+def instrument(s3_client):
+    """
+    Measure every request of the client. The clients are shared and cached, so this is done once, when the client is
+    created, and the measurements go to the run of the thread that sends the request. Retried attempts are counted from the response
+    metadata, throttled attempts when botocore decides about retrying them.
+    """
+    s3_client.meta.events.register('before-call.s3', __on_before_call)
+    s3_client.meta.events.register('after-call.s3', __on_after_call)
+    s3_client.meta.events.register('after-call-error.s3', __on_after_call_error)
+    s3_client.meta.events.register('needs-retry.s3', __on_needs_retry)
+
+
+@contextmanager
+def measuring(command: str, flags: dict):
+    """
+    Collect the metrics of a command, and save the report when it is finished. With the "--profile" flag the command
+    is also profiled with cProfile and tracemalloc, with "--prometheus=<file>" the metrics are also written into
+    a Prometheus textfile.
+    """
+    run = RunMetrics(command)
+    token = current_run.set(run)
+    metrics_folder = pathlib.Path(constants.METRICS_FOLDER)
+    metrics_folder.mkdir(exist_ok=True)
+    file_prefix = metrics_folder.joinpath(f'{command}-{time.strftime("%Y%m%d-%H%M%S")}')
+    try:
+        with __profiling(run, file_prefix) if flags.get('profile', False) else nullcontext():
+            yield run
+    finally:
+        current_run.reset(token)
+        run.finished_at = time.time()
+        run.write_report(file_prefix.with_suffix('.json'))
+        if isinstance(flags.get('prometheus'), str):
+            run.write_prometheus_textfile(pathlib.Path(flags['prometheus']))
+        run.print_summary()
+        print(f'The metrics of the run are saved to "{file_prefix.with_suffix(".json")}".')
+
+
+@contextmanager
+def __profiling(run: RunMetrics, file_prefix: pathlib.Path):
+    profilers = [cProfile.Profile()]
+
+    def profile_new_thread(*_):
+        # called once in every new thread, then the profiler takes over as the profile function of the thread
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+
+    if sys.version_info < (3, 12):
+        # before 3.12, the profiler only sees the thread that enabled it, and the work is done in worker threads
+        threading.setprofile(profile_new_thread)
+    tracemalloc.start(constants.METRICS_TRACEMALLOC_FRAMES)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        statistics = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            statistics.add(profiler)
+        statistics.dump_stats(file_prefix.with_suffix('.prof'))
+        summary = io.StringIO()
+        pstats.Stats(file_prefix.with_suffix('.prof').as_posix(), stream=summary).sort_stats('cumulative').print_stats(constants.METRICS_PROFILE_TOP_ENTRIES)
+        with open(file_prefix.with_suffix('.profile.txt'), 'w') as profile_file:
+            profile_file.write(summary.getvalue())
+        with open(file_prefix.with_suffix('.memory.txt'), 'w') as memory_file:
+            memory_file.write(f'Peak traced memory: {peak_memory} bytes\n')
+            for statistic in snapshot.statistics('lineno')[:constants.METRICS_PROFILE_TOP_ENTRIES]:
+                memory_file.write(f'{statistic}\n')
+        run.profile_files = {
+            'cprofile': file_prefix.with_suffix('.prof').as_posix(),
+            'summary': file_prefix.with_suffix('.profile.txt').as_posix(),
+            'memory': file_prefix.with_suffix('.memory.txt').as_posix(),
+            'peak_traced_memory_bytes': peak_memory
+        }
+        print(f'The profile of the command is saved to "{file_prefix.with_suffix(".profile.txt")}" and "{file_prefix.with_suffix(".memory.txt")}".')
+
+
+def __operation_name(event_name: str) -> str:
+    return event_name.rsplit('.', 1)[-1]
+
+
+def __on_before_call(context: dict, **kwargs):
+    context['metrics_started_at'] = time.perf_counter()
+
+
+def __on_after_call(event_name: str, http_response, parsed: dict, context: dict, **kwargs):
+    run = current_run.get()
+    if run is None or 'metrics_started_at' not in context:
+        return
+    operation = __operation_name(event_name)
+    run.count('s3_requests', 1, operation)
+    run.observe('s3_request_seconds', time.perf_counter() - context['metrics_started_at'], operation)
+    run.count('s3_retries', parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), operation)
+    if http_response.status_code >= 300:
+        run.count('s3_errors', 1, operation)
+
+
+def __on_after_call_error(event_name: str, context: dict, **kwargs):
+    run = current_run.get()
+    if run is None or 'metrics_started_at' not in context:
+        return
+    operation = __operation_name(event_name)
+    run.count('s3_requests', 1, operation)
+    run.observe('s3_request_seconds', time.perf_counter() - context['metrics_started_at'], operation)
+    run.count('s3_errors', 1, operation)
+
+
+def __on_needs_retry(event_name: str, response=None, **kwargs):
+    run = current_run.get()
+    if run is None or response is None:
+        return None
+    http_response, parsed_response = response
+    if parsed_response.get('Error', {}).get('Code') in constants.S3_THROTTLING_ERROR_CODES or http_response.status_code == 503:
+        run.count('s3_throttles', 1, __operation_name(event_name))
+    return None
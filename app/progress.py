@@ -0,0 +1,228 @@
+import collections
+import sys
+import threading
+import time
+import traceback
+from typing import Union
+
+import constants
+
+
+class WorkerCounters:
+    """
+    Progress of one worker thread. Only the owning thread writes it, so no lock is needed: the render thread
+    reads the counters while they change, which is at most a few objects behind.
+    """
+
+    def __init__(self):
+        self.completed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.deferred = 0
+        self.bytes = 0
+        # size of the skipped and failed objects, these are not transferred, but are not remaining either
+        self.settled_bytes = 0
+        self.failures: list[tuple[str, str]] = []
+
+    def processed(self) -> int:
+        # deferred objects may be processed again later, so they are not counted here
+        return self.completed + self.skipped + self.failed
+
+
+class Progress:
+    """
+    Aggregates the progress of the workers of a command, and renders it as a single line that is refreshed a few
+    times a second, with the rates and the estimated time left. The outcome of every object is written only to the
+    optional log file. Every run of a command has its own instance, so commands can run at the same time.
+    """
+
+    def __init__(self, action: str, total_files: int, total_bytes: int = 0, log_path: Union[str, None] = None):
+        self.action = action
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.log_path = log_path
+        self.__local = threading.local()
+        self.__all_counters: list[WorkerCounters] = []
+        self.__counters_lock = threading.Lock()
+        self.__output_lock = threading.Lock()
+        self.__stopped = threading.Event()
+        self.__interactive = sys.stdout.isatty()
+        self.__rate_samples = collections.deque()
+        self.__line_length = 0
+        self.__last_rendered_at = 0.0
+        self.__log_file = open(log_path, 'a', encoding='utf-8') if log_path is not None else None
+        self.__renderer = threading.Thread(target=self.__render_periodically, daemon=True)
+
+    def __enter__(self) -> 'Progress':
+        self.__started_at = time.monotonic()
+        self.__log(f'{self.action} of {self.total_files} files started')
+        self.__renderer.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.__stopped.set()
+        self.__renderer.join()
+        with self.__output_lock:
+            self.__render(final=True)
+        totals = self.totals()
+        self.__log(f'{self.action} finished: {totals.completed} completed, {totals.skipped} skipped, '
+                   f'{totals.failed} failed, {totals.deferred} not ready')
+        if self.__log_file is not None:
+            self.__log_file.close()
+        self.__print_failures(totals.failures)
+
+    def completed(self, key: str, size: int = 0, detail: str = 'done'):
+        counters = self.__counters()
+        counters.completed += 1
+        counters.bytes += size
+        self.__log(f'OK {key}: {detail}')
+
+    def skipped(self, key: str, detail: str, size: int = 0):
+        counters = self.__counters()
+        counters.skipped += 1
+        counters.settled_bytes += size
+        self.__log(f'SKIPPED {key}: {detail}')
+
+    def failed(self, key: str, reason: str, size: int = 0, with_traceback: bool = False):
+        counters = self.__counters()
+        counters.failed += 1
+        counters.settled_bytes += size
+        counters.failures.append((key, reason))
+        self.__log(f'FAILED {key}: {reason}' + (f'\n{traceback.format_exc()}' if with_traceback else ''))
+
+    def deferred(self, key: str, detail: str):
+        """
+        The object can not be processed yet (for example it is not restored), this is not an error of the program.
+        """
+        self.__counters().deferred += 1
+        self.__log(f'NOT READY {key}: {detail}')
+
+    def note(self, key: str, detail: str):
+        """
+        Detail about an object, that does not change the counts.
+        """
+        self.__log(f'NOTE {key}: {detail}')
+
+    def print(self, message: str):
+        """
+        Print a message during the run, without mixing it into the progress line.
+        """
+        with self.__output_lock:
+            if self.__interactive:
+                sys.stdout.write('\r' + ' ' * self.__line_length + '\r')
+                self.__line_length = 0
+            print(message, flush=True)
+        self.__log(message)
+
+    def totals(self) -> WorkerCounters:
+        totals = WorkerCounters()
+        with self.__counters_lock:
+            all_counters = list(self.__all_counters)
+        for counters in all_counters:
+            totals.completed += counters.completed
+            totals.skipped += counters.skipped
+            totals.failed += counters.failed
+            totals.deferred += counters.deferred
+            totals.bytes += counters.bytes
+            totals.settled_bytes += counters.settled_bytes
+            totals.failures.extend(counters.failures)
+        return totals
+
+    def __counters(self) -> WorkerCounters:
+        counters = getattr(self.__local, 'counters', None)
+        if counters is None:
+            # only the first update of a thread takes the lock
+            counters = WorkerCounters()
+            self.__local.counters = counters
+            with self.__counters_lock:
+                self.__all_counters.append(counters)
+        return counters
+
+    def __log(self, message: str):
+        if self.__log_file is None:
+            return
+        line = f'{time.strftime("%Y-%m-%d %H:%M:%S")} {message}\n'
+        with self.__output_lock:
+            self.__log_file.write(line)
+
+    def __render_periodically(self):
+        while not self.__stopped.wait(constants.PROGRESS_RENDER_INTERVAL_SECONDS):
+            with self.__output_lock:
+                # without a terminal every line is kept, so they are printed much less often
+                if self.__interactive or time.monotonic() - self.__last_rendered_at >= constants.PROGRESS_PLAIN_INTERVAL_SECONDS:
+                    self.__render(final=False)
+
+    def __render(self, final: bool):
+        now = time.monotonic()
+        totals = self.totals()
+        processed = totals.processed()
+        files_per_second, bytes_per_second = self.__rates(now, processed, totals.bytes, final)
+
+        parts = [f'{self.action}: {processed}/{self.total_files} files ({self.__percent(processed, self.total_files)}%)',
+                 f'{files_per_second:.1f} files/s']
+        if self.total_bytes > 0:
+            parts.append(f'{bytes_per_second / (1024*1024):.1f} MB/s')
+        if totals.skipped > 0:
+            parts.append(f'{totals.skipped} skipped')
+        if totals.deferred > 0:
+            parts.append(f'{totals.deferred} not ready')
+        parts.append(f'{totals.failed} errors')
+        if final:
+            parts.append(f'took {self.__format_duration(now - self.__started_at)}')
+        else:
+            parts.append(f'ETA {self.__eta(processed, totals.bytes + totals.settled_bytes, files_per_second, bytes_per_second)}')
+        line = ' | '.join(parts)
+
+        if self.__interactive:
+            # the previous line may have been longer
+            sys.stdout.write('\r' + line.ljust(self.__line_length) + ('\n' if final else ''))
+            self.__line_length = 0 if final else len(line)
+        else:
+            sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+        self.__last_rendered_at = now
+
+    def __rates(self, now: float, processed: int, transferred_bytes: int, final: bool) -> tuple[float, float]:
+        """
+        The rates of the last few seconds, so that the estimate follows the current speed. The final line
+        shows the average of the whole run.
+        """
+        if final:
+            elapsed = max(now - self.__started_at, 1e-9)
+            return processed / elapsed, transferred_bytes / elapsed
+        self.__rate_samples.append((now, processed, transferred_bytes))
+        while len(self.__rate_samples) > 1 and self.__rate_samples[0][0] < now - constants.PROGRESS_RATE_WINDOW_SECONDS:
+            self.__rate_samples.popleft()
+        oldest_at, oldest_processed, oldest_bytes = self.__rate_samples[0]
+        if len(self.__rate_samples) == 1:
+            oldest_at, oldest_processed, oldest_bytes = self.__started_at, 0, 0
+        elapsed = max(now - oldest_at, 1e-9)
+        return (processed - oldest_processed) / elapsed, (transferred_bytes - oldest_bytes) / elapsed
+
+    def __eta(self, processed: int, finished_bytes: int, files_per_second: float, bytes_per_second: float) -> str:
+        # the remaining bytes are a better estimate for transfers, the mix of file sizes varies over the run
+        if self.total_bytes > 0 and bytes_per_second > 0:
+            return self.__format_duration(max(0, self.total_bytes - finished_bytes) / bytes_per_second)
+        if files_per_second > 0:
+            return self.__format_duration(max(0, self.total_files - processed) / files_per_second)
+        return '--:--:--'
+
+    def __print_failures(self, failures: list[tuple[str, str]]):
+        if len(failures) == 0:
+            return
+        print(f'{len(failures)} files failed:')
+        for key, reason in failures[:constants.PROGRESS_REPORTED_FAILURES]:
+            print(f'  {key}: {reason}')
+        if len(failures) > constants.PROGRESS_REPORTED_FAILURES:
+            print(f'  ({len(failures) - constants.PROGRESS_REPORTED_FAILURES} more are not shown)')
+        if self.log_path is not None:
+            print(f'The details of every file are in the log "{self.log_path}".')
+
+    @staticmethod
+    def __percent(processed: int, total: int) -> float:
+        return round(processed / total * 100, 1) if total > 0 else 100.0
+
+    @staticmethod
+    def __format_duration(seconds: float) -> str:
+        seconds = int(seconds)
+        return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
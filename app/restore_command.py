@@ -1,115 +1,208 @@
-import multiprocessing.pool
-import threading
 import time
-import traceback
+import pathlib
+from typing import Iterable, Iterator, Union
 
 import boto3
 import botocore.client
 
+import archive_index
+import async_core
 import constants
 import commons
+import progress
+import restore_state
 
 
-def process_restore_command(aws_session: boto3.Session, user_id: str, command_data: str):
+def process_restore_command(root: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
     """
     After a confirmation, this command triggers the restoration of the DEEP_ARCHIVE objects
-    with the given prefix.
+    with the given prefix. Objects that are already restored, or are being restored according to the
+    local restore state index are skipped.
+    :param root: Root folder of the archive, the restore state index is stored here.
     :param aws_session: AWS session with correct credentials that only allow the users prefix.
     :param user_id: ID of the user used as S3 prefix.
     :param command_data: Objects will be restored with this prefix.
+    :param flags: Optional flags of the command. With "--log=<file>", the outcome of every object is written into the file.
     """
     print(f'Checking the objects for restoration with prefix {command_data}...')
     s3_client = commons.build_s3_client(aws_session)
 
     full_prefix, internal_prefix = commons.create_prefix_with_user_id(user_id, command_data)
 
-    object_count = commons.count_objects_with_prefix(s3_client, full_prefix)
+    index = archive_index.load_archive_index(s3_client, user_id)
+    state_index = restore_state.RestoreStateIndex(root)
+    try:
+        with commons.count_objects_with_prefix(s3_client, full_prefix, index) as object_listing:
+            indexed_object_keys = __find_indexed_objects_with_prefix(index, full_prefix.removeprefix(internal_prefix))
+            known_states = __load_known_states(state_index, internal_prefix)
+            status_counts = __count_statuses(__target_keys(object_listing, indexed_object_keys), known_states)
+            total_count = status_counts[restore_state.STATUS_ARCHIVED]
+
+            print(f'Found {object_listing.count} objects with total size of {object_listing.total_size_in_gb()} GB.')
+            if len(indexed_object_keys) > 0:
+                print(f'Additionally, {len(indexed_object_keys)} bundles or deduplicated objects contain files with this prefix.')
+            print(f'According to the restore state index, {status_counts[restore_state.STATUS_READY]} of these are already restored'
+                  f' and {status_counts[restore_state.STATUS_PENDING]} are being restored, these will be skipped.')
+            if total_count == 0:
+                print('There are no objects that need to be restored.')
+                return
+
+            print(f'A total of {total_count} objects will be restored!')
+            proceed = input('Are you sure you want to proceed? (Y) ')
+
+            if proceed == 'Y':
+                print(f'Starting restoration process for selected objects with up to {constants.RESTORE_MAX_CONCURRENCY} requests in flight at {time.ctime()}')
+                keys_to_restore = (key for key in __target_keys(object_listing, indexed_object_keys)
+                                   if __status_of(key, known_states) == restore_state.STATUS_ARCHIVED)
+                with commons.catch_time() as restore_timer:
+                    started_restorations_count = __restore_objects(aws_session, keys_to_restore, total_count, internal_prefix, state_index, flags.get('log'))
+                print(f'Restoration was successfully started for {started_restorations_count}/{total_count} objects at {time.ctime()}'
+                      f' and took {restore_timer():.4f} seconds. It will take up to 48 hours to complete restorations. Check back later.')
+            else:
+                print('Aborting restoration...')
+    finally:
+        state_index.close()
+
+
+def process_restore_status_command(root: pathlib.Path, aws_session: boto3.Session, user_id: str, command_data: str, flags: dict):
+    """
+    Reports how many objects with the prefix are restored, being restored or still archived. By default
+    only the local restore state index is used. With the "--refresh" flag the objects that are being restored
+    are checked with HEAD requests, and "--refresh=all" checks every object.
+    :param root: Root folder of the archive, the restore state index is stored here.
+    :param aws_session: AWS session with correct credentials that only allow the users prefix.
+    :param user_id: ID of the user used as S3 prefix.
+    :param command_data: Status of objects with this prefix is reported.
+    :param flags: Optional flags of the command.
+    """
+    print(f'Checking the restoration status of objects with prefix {command_data}...')
+    s3_client = commons.build_s3_client(aws_session)
 
-    print(f'A total of {object_count.count} objects will be restored, with total size of {object_count.total_size_in_gb()} GB!')
-    proceed = input('Are you sure you want to proceed? (Y) ')
+    full_prefix, internal_prefix = commons.create_prefix_with_user_id(user_id, command_data)
 
-    if proceed == 'Y':
-        print(f'Starting restoration process for selected objects using {constants.THREADS} parallel processes at {time.ctime()}')
-        with commons.catch_time() as restore_timer:
-            started_restorations_count = __restore_objects(aws_session, object_count.pages, object_count.count, internal_prefix)
-        print(f'Restoration was successfully started for {started_restorations_count}/{object_count.count} objects at {time.ctime()}'
-              f' and took {restore_timer():.4f} seconds. It will take up to 48 hours to complete restorations. Check back later.')
-    else:
-        print('Aborting restoration...')
+    index = archive_index.load_archive_index(s3_client, user_id)
+    state_index = restore_state.RestoreStateIndex(root)
+    try:
+        with commons.count_objects_with_prefix(s3_client, full_prefix, index) as object_listing:
+            indexed_object_keys = __find_indexed_objects_with_prefix(index, full_prefix.removeprefix(internal_prefix))
+            known_states = __load_known_states(state_index, internal_prefix)
+
+            refresh = flags.get('refresh')
+            if refresh:
+                refresh_all = refresh == 'all'
+                keys_to_refresh = (key for key in __target_keys(object_listing, indexed_object_keys)
+                                   if refresh_all or __status_of(key, known_states) == restore_state.STATUS_PENDING)
+                with commons.catch_time() as refresh_timer:
+                    refreshed_count = __refresh_states(aws_session, keys_to_refresh, state_index)
+                print(f'Refreshed the status of {refreshed_count} objects in {refresh_timer():.4f} seconds.')
+                known_states = __load_known_states(state_index, internal_prefix)
+
+            status_counts = __count_statuses(__target_keys(object_listing, indexed_object_keys), known_states)
+            print(f'Ready for download: {status_counts[restore_state.STATUS_READY]}')
+            print(f'Being restored: {status_counts[restore_state.STATUS_PENDING]}')
+            print(f'Archived: {status_counts[restore_state.STATUS_ARCHIVED]}')
+    finally:
+        state_index.close()
+
+
+def __find_indexed_objects_with_prefix(index: archive_index.ArchiveIndex, relative_prefix: str) -> list[str]:
+    """
+    Find the objects (bundles, deduplicated content) that store at least one file with the prefix. These
+    can only be restored as a whole.
+    """
+    return sorted({entry.object_key for entry in index.entries_with_prefix(relative_prefix)})
 
 
-restoration_progress_count = 0
-successfully_started_restorations_count = 0
+def __target_keys(object_listing: commons.ObjectListing, indexed_object_keys: list[str]) -> Iterator[str]:
+    for page in object_listing.pages(constants.LIST_PAGE_SIZE):
+        for key, _ in page:
+            yield key
+    yield from indexed_object_keys
 
 
-def __restore_objects(
-        aws_session: boto3.Session,
-        pages,
-        object_count: int,
-        internal_prefix: str
-) -> int:
-    global restoration_progress_count, successfully_started_restorations_count
+def __load_known_states(state_index: restore_state.RestoreStateIndex, internal_prefix: str) -> dict[str, restore_state.RestoreState]:
+    return {state.key: state for state in state_index.states_with_prefix(internal_prefix)}
 
-    restoration_progress_count = 0
-    successfully_started_restorations_count = 0
 
-    thread_pool = multiprocessing.pool.ThreadPool(processes=constants.THREADS)
-    lock = threading.Lock()
+def __status_of(key: str, known_states: dict[str, restore_state.RestoreState]) -> str:
+    return restore_state.status_of(known_states.get(key), time.time())
 
-    for page in pages:
-        thread_pool.apply_async(__restore_objects_page, (aws_session, page, lock, object_count, internal_prefix))
 
-    thread_pool.close()
-    thread_pool.join()
+def __count_statuses(keys: Iterable[str], known_states: dict[str, restore_state.RestoreState]) -> dict[str, int]:
+    status_counts = {restore_state.STATUS_READY: 0, restore_state.STATUS_PENDING: 0, restore_state.STATUS_ARCHIVED: 0}
+    for key in keys:
+        status_counts[__status_of(key, known_states)] += 1
+    return status_counts
 
-    return successfully_started_restorations_count
 
-
-def __restore_objects_page(
+def __restore_objects(
         aws_session: boto3.Session,
-        page,
-        lock: threading.Lock,
+        keys_to_restore: Iterable[str],
         object_count: int,
-        internal_prefix: str
-):
-    global restoration_progress_count, successfully_started_restorations_count
+        internal_prefix: str,
+        state_index: restore_state.RestoreStateIndex,
+        log_path: Union[str, None]
+) -> int:
+    # restore requests are tiny, so a lot of them can be in flight on the same client
+    s3_client = commons.build_s3_client(aws_session)
+    concurrency = async_core.AdaptiveConcurrency('restore requests', constants.RESTORE_INITIAL_CONCURRENCY, constants.RESTORE_MAX_CONCURRENCY)
+    with progress.Progress('Restoring', object_count, log_path=log_path) as restore_progress, concurrency.watching(s3_client):
+        async_core.run_bounded(keys_to_restore, __restore_object, (s3_client, restore_progress, internal_prefix, state_index), concurrency)
+    concurrency.print_summary('requests/s')
+
+    return restore_progress.totals().completed
 
+
+def __restore_object(
+        key: str,
+        s3_client,
+        restore_progress: progress.Progress,
+        internal_prefix: str,
+        state_index: restore_state.RestoreStateIndex
+):
+    user_friendly_key = key.removeprefix(internal_prefix)
+    try:
+        response = s3_client.restore_object(
+            Bucket=constants.ARCHIVE_BUCKET_NAME,
+            Key=key,
+            RestoreRequest={
+                'GlacierJobParameters': {
+                    'Tier': 'Bulk',
+                },
+                'Days': constants.RESTORE_DAYS
+            }
+        )
+        status_code = response['ResponseMetadata']['HTTPStatusCode']
+        if status_code == 202:
+            state_index.record_pending(key)
+            restore_progress.completed(user_friendly_key, detail='restoration started')
+        else:
+            # restoring an already restored object extends the expiry of the restored copy
+            state_index.record_ready(key, time.time() + constants.RESTORE_DAYS * 24 * 60 * 60)
+            restore_progress.skipped(user_friendly_key, 'already restored and ready for download')
+    except botocore.client.ClientError as e:
+        if e.response['Error']['Code'] == 'RestoreAlreadyInProgress':
+            state_index.record_pending(key)
+            restore_progress.skipped(user_friendly_key, 'already being restored')
+        else:
+            restore_progress.failed(user_friendly_key, f'restoration could not be started: {e.response["Error"]["Code"]}', with_traceback=True)
+
+
+def __refresh_states(aws_session: boto3.Session, keys_to_refresh: Iterable[str], state_index: restore_state.RestoreStateIndex) -> int:
+    refreshed_keys = []
     s3_client = commons.build_s3_client(aws_session)
-    if 'Contents' in page:
-        for s3_object in page['Contents']:
-            key = s3_object['Key']
-            user_friendly_key = key.removeprefix(internal_prefix)
-            progress_percent = __update_progress(lock, object_count)
-            try:
-                response = s3_client.restore_object(
-                    Bucket=constants.ARCHIVE_BUCKET_NAME,
-                    Key=key,
-                    RestoreRequest={
-                        'GlacierJobParameters': {
-                            'Tier': 'Bulk',
-                        },
-                        'Days': 10
-                    }
-                )
-                status_code = response['ResponseMetadata']['HTTPStatusCode']
-                if status_code == 202:
-                    print(f'Restoration started for object "{user_friendly_key}"... {progress_percent}% complete')
-                    with lock:
-                        successfully_started_restorations_count += 1
-                else:
-                    print(f'The object "{user_friendly_key} is already restored and ready for download... {progress_percent}% complete"')
-            except botocore.client.ClientError as e:
-                if e.response['Error']['Code'] == 'RestoreAlreadyInProgress':
-                    print(f'The object "{user_friendly_key} is currently being restored, please wait for finish... {progress_percent}% complete"')
-                else:
-                    print(f'Restoration of object "{user_friendly_key}" could not be started: {e.response["Error"]["Code"]}! {progress_percent}% complete')
-                    traceback.print_exc()
-
-
-def __update_progress(lock: threading.Lock, total_count: int) -> float:
-    global restoration_progress_count
-
-    with lock:
-        restoration_progress_count += 1
-
-    return round((restoration_progress_count/total_count)*100, 3)
+    concurrency = async_core.AdaptiveConcurrency('status checks', constants.HEAD_INITIAL_CONCURRENCY, constants.HEAD_MAX_CONCURRENCY)
+    with concurrency.watching(s3_client):
+        async_core.run_bounded(keys_to_refresh, __refresh_state, (s3_client, state_index, refreshed_keys), concurrency)
+    concurrency.print_summary('requests/s')
+    return len(refreshed_keys)
+
+
+def __refresh_state(key: str, s3_client, state_index: restore_state.RestoreStateIndex, refreshed_keys: list[str]):
+    try:
+        restore_state.refresh_state(s3_client, state_index, key)
+    except botocore.client.ClientError as e:
+        print(f'Failed to check the status of object "{key}": {e.response["Error"]["Code"]}')
+        return
+    refreshed_keys.append(key)
+
@@ -0,0 +1,153 @@
+import datetime
+import email.utils
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from typing import Union
+
+import constants
+
+STATUS_PENDING = 'pending'
+STATUS_READY = 'ready'
+STATUS_ARCHIVED = 'archived'
+
+__restore_header_pattern = re.compile(r'ongoing-request="(?P<ongoing>true|false)"(,\s*expiry-date="(?P<expiry>[^"]+)")?')
+
+
+class RestoreState:
+
+    def __init__(self, key: str, status: str, requested_at: float, expires_at: Union[float, None]):
+        self.key = key
+        self.status = status
+        self.requested_at = requested_at
+        self.expires_at = expires_at
+
+
+class RestoreStateIndex:
+    """
+    Local record of the restore requests that were submitted, and what is known about their progress.
+    It is an SQLite database placed inside the root folder. With it, the restore command can skip
+    objects that are already restored or under restoration, without calling S3 for each of them.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        self.path = root.joinpath(constants.RESTORE_STATE_FILE_NAME)
+        self.__lock = threading.Lock()
+        self.__pending_writes = 0
+        self.__connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self.__lock:
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS restores ('
+                'key TEXT PRIMARY KEY, '
+                'status TEXT NOT NULL, '
+                'requested_at REAL NOT NULL, '
+                'expires_at REAL)'
+            )
+            self.__connection.commit()
+
+    def lookup(self, key: str) -> Union[RestoreState, None]:
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT key, status, requested_at, expires_at FROM restores WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return RestoreState(*row)
+
+    def states_with_prefix(self, prefix: str) -> list[RestoreState]:
+        with self.__lock:
+            rows = self.__connection.execute(
+                'SELECT key, status, requested_at, expires_at FROM restores WHERE substr(key, 1, ?) = ?', (len(prefix), prefix)
+            ).fetchall()
+        return [RestoreState(*row) for row in rows]
+
+    def current_status(self, key: str, now: float = None) -> str:
+        """
+        Status of the object based only on the local record. Restorations that take longer than
+        expected, and expired restored copies count as archived.
+        """
+        return status_of(self.lookup(key), time.time() if now is None else now)
+
+    def record_pending(self, key: str, requested_at: float = None):
+        self.__save(key, STATUS_PENDING, time.time() if requested_at is None else requested_at, None)
+
+    def record_ready(self, key: str, expires_at: float):
+        existing_state = self.lookup(key)
+        requested_at = existing_state.requested_at if existing_state is not None else time.time()
+        self.__save(key, STATUS_READY, requested_at, expires_at)
+
+    def record_archived(self, key: str):
+        with self.__lock:
+            self.__connection.execute('DELETE FROM restores WHERE key = ?', (key,))
+            self.__commit_in_batches()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.commit()
+            self.__connection.close()
+
+    def __save(self, key: str, status: str, requested_at: float, expires_at: Union[float, None]):
+        with self.__lock:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO restores (key, status, requested_at, expires_at) VALUES (?, ?, ?, ?)',
+                (key, status, requested_at, expires_at)
+            )
+            self.__commit_in_batches()
+
+    def __commit_in_batches(self):
+        """
+        Writes are committed in batches, call close to make sure everything is persisted.
+        """
+        self.__pending_writes += 1
+        if self.__pending_writes >= constants.CATALOG_COMMIT_INTERVAL:
+            self.__connection.commit()
+            self.__pending_writes = 0
+
+
+def status_of(state: Union[RestoreState, None], now: float) -> str:
+    if state is None:
+        return STATUS_ARCHIVED
+    if state.status == STATUS_READY and state.expires_at is not None and state.expires_at > now + constants.RESTORE_EXPIRY_MARGIN_SECONDS:
+        return STATUS_READY
+    if state.status == STATUS_PENDING and state.requested_at > now - constants.RESTORE_PENDING_TIMEOUT_SECONDS:
+        return STATUS_PENDING
+    return STATUS_ARCHIVED
+
+
+def parse_restore_header(restore_header: Union[str, None]) -> tuple[str, Union[float, None]]:
+    """
+    Parse the "Restore" header of a HEAD response.
+    :return: Status of the object, and expiry timestamp of the restored copy if it is ready.
+    """
+    if restore_header is None:
+        return STATUS_ARCHIVED, None
+    match = __restore_header_pattern.search(restore_header)
+    if match is None:
+        return STATUS_ARCHIVED, None
+    if match.group('ongoing') == 'true':
+        return STATUS_PENDING, None
+    expiry = match.group('expiry')
+    if expiry is None:
+        return STATUS_READY, None
+    expires_at: datetime.datetime = email.utils.parsedate_to_datetime(expiry)
+    return STATUS_READY, expires_at.timestamp()
+
+
+def refresh_state(s3_client, state_index: RestoreStateIndex, key: str) -> str:
+    """
+    Update the restore state of an object from the "Restore" header of a HEAD request.
+    :return: The current status of the object.
+    """
+    response = s3_client.head_object(Bucket=constants.ARCHIVE_BUCKET_NAME, Key=key)
+    status, expires_at = parse_restore_header(response.get('Restore'))
+    if status == STATUS_READY:
+        state_index.record_ready(key, expires_at if expires_at is not None else time.time() + constants.RESTORE_DAYS * 24 * 60 * 60)
+    elif status == STATUS_PENDING:
+        # the original request time is kept, unless the restoration takes longer than expected
+        if state_index.current_status(key) != STATUS_PENDING:
+            state_index.record_pending(key)
+    else:
+        state_index.record_archived(key)
+    return status
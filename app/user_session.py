@@ -0,0 +1,122 @@
+import datetime
+import json
+import os
+import os.path as path
+import threading
+from typing import Union
+
+import boto3
+import botocore.session
+from botocore.credentials import CredentialProvider, RefreshableCredentials
+from botocore.exceptions import BotoCoreError, ClientError
+
+import constants
+import login
+
+
+class UserSession:
+    """
+    Everything needed to start the program without signing in again: the refresh token of the user pool, the
+    identity ID (which is also the user ID) and the last temporary AWS credentials. It is saved into a file that
+    only the owner can read, because the refresh token is as good as the password until it expires.
+    """
+
+    def __init__(self, email: str, user_id: str, refresh_token: str, credentials: dict):
+        self.email = email
+        self.user_id = user_id
+        self.refresh_token = refresh_token
+        self.credentials = credentials
+        self.__lock = threading.Lock()
+
+    def credentials_valid_for(self, seconds: int) -> bool:
+        expiry_time = datetime.datetime.fromisoformat(self.credentials['expiry_time'])
+        return expiry_time - datetime.datetime.now(datetime.timezone.utc) > datetime.timedelta(seconds=seconds)
+
+    def refresh_credentials(self) -> dict:
+        """
+        Exchange the refresh token for new temporary AWS credentials, and save them for the next start.
+        """
+        id_token = login.refresh_id_token(self.refresh_token)
+        credentials = login.exchange_token_for_aws_credentials(self.user_id, id_token)
+        with self.__lock:
+            self.credentials = credentials
+            save_session(self)
+        return credentials
+
+    def to_json(self) -> dict:
+        return {
+            'email': self.email,
+            'user_id': self.user_id,
+            'refresh_token': self.refresh_token,
+            'credentials': self.credentials
+        }
+
+
+class CognitoCredentialProvider(CredentialProvider):
+    """
+    Provides the credentials of the user session to botocore, which refreshes them in time, before they expire.
+    """
+    METHOD = 'cognito-identity'
+    CANONICAL_NAME = 'CognitoIdentity'
+
+    def __init__(self, user_session: UserSession):
+        super().__init__()
+        self.__user_session = user_session
+
+    def load(self):
+        return RefreshableCredentials.create_from_metadata(
+            metadata=self.__user_session.credentials,
+            refresh_using=self.__user_session.refresh_credentials,
+            method=self.METHOD
+        )
+
+
+def resume_session() -> Union[UserSession, None]:
+    """
+    Continue the session of the previous run. Cached credentials are used without contacting AWS, if they
+    are still valid for a while, otherwise new ones are requested with the refresh token.
+    :return: None if there is no session, the refresh token is no longer accepted, or Cognito can't be reached.
+    """
+    if not path.isfile(constants.SESSION_FILE_NAME):
+        return None
+    try:
+        with open(constants.SESSION_FILE_NAME, 'r') as session_file:
+            session_data = json.load(session_file)
+        user_session = UserSession(session_data['email'], session_data['user_id'], session_data['refresh_token'], session_data['credentials'])
+    except (OSError, ValueError, KeyError):
+        print('The saved session is unreadable, you need to sign in again')
+        return None
+    if user_session.credentials_valid_for(constants.SESSION_MIN_CREDENTIALS_LIFETIME_SECONDS):
+        return user_session
+    try:
+        user_session.refresh_credentials()
+        return user_session
+    except ClientError as e:
+        print(f'The saved session has expired ({e.response["Error"]["Code"]}), you need to sign in again')
+        return None
+    except BotoCoreError as e:
+        print(f'The saved session could not be continued: {e}')
+        return None
+
+
+def save_session(user_session: UserSession):
+    """
+    Write the session through a temporary file, which is created with owner only permissions.
+    """
+    temporary_path = f'{constants.SESSION_FILE_NAME}.tmp'
+    file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # the permissions of a leftover temporary file are not changed by the open
+    os.chmod(temporary_path, 0o600)
+    with os.fdopen(file_descriptor, 'w') as session_file:
+        json.dump(user_session.to_json(), session_file)
+    os.replace(temporary_path, constants.SESSION_FILE_NAME)
+
+
+def create_aws_session(user_session: UserSession) -> boto3.Session:
+    """
+    Create a session with refreshable credentials, so that commands running for hours don't fail when
+    the temporary credentials expire.
+    """
+    botocore_session = botocore.session.get_session()
+    botocore_session.get_component('credential_provider').insert_before('env', CognitoCredentialProvider(user_session))
+    return boto3.Session(botocore_session=botocore_session, region_name=constants.AWS_REGION)
@@ -0,0 +1,231 @@
+"""
+Benchmarks of the archive, list, restore and download commands against a local S3 emulator (moto server).
+
+Every scenario builds a synthetic tree, then runs the commands on it in a separate process, so that the
+peak memory of the scenarios can be compared. Latency can be added to every request to mimic a real
+connection. The results are written as JSON, and can be compared with the results of an earlier run:
+
+    python benchmarks/benchmark.py --latency-ms 20 --output results.json
+    python benchmarks/benchmark.py --latency-ms 20 --compare results.json
+"""
+import argparse
+import builtins
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import pathlib
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCHMARKS_FOLDER = pathlib.Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCHMARKS_FOLDER.parent.joinpath('app')))
+
+import boto3
+
+import archive_command
+import commons
+import constants
+import download_command
+import list_command
+import restore_command
+import synthetic_trees
+
+USER_ID = 'benchmark-user'
+TREE_FOLDER = 'benchmark_tree'
+REGRESSION_THRESHOLD = 1.1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the archive commands against a local S3 emulator.')
+    parser.add_argument('--scenarios', nargs='+', default=list(synthetic_trees.TREE_BUILDERS), choices=list(synthetic_trees.TREE_BUILDERS))
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiplier of the file counts and sizes of the trees.')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Latency added to every request.')
+    parser.add_argument('--archive-flags', default='', help='Flags of archive_data, such as --archive-flags="--pack --dedup".')
+    parser.add_argument('--port', type=int, default=5123, help='Port of the moto server.')
+    parser.add_argument('--output', type=pathlib.Path, default=None, help='JSON file of the results.')
+    parser.add_argument('--compare', type=pathlib.Path, default=None, help='Results of an earlier run to compare with.')
+    parser.add_argument('--run-scenario', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--endpoint-url', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', type=pathlib.Path, default=None, help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+
+    if arguments.run_scenario is not None:
+        result = run_scenario(arguments.run_scenario, arguments.endpoint_url, arguments.scale, arguments.latency_ms, arguments.archive_flags)
+        arguments.result_file.write_text(json.dumps(result))
+        return
+
+    results = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'version': git_version(),
+        'config': {
+            'scale': arguments.scale,
+            'latency_ms': arguments.latency_ms,
+            'archive_flags': arguments.archive_flags
+        },
+        'scenarios': dict()
+    }
+    endpoint_url = f'http://127.0.0.1:{arguments.port}'
+    with moto_server(arguments.port):
+        for scenario in arguments.scenarios:
+            print(f'Running scenario {scenario}...')
+            results['scenarios'][scenario] = run_scenario_process(scenario, endpoint_url, arguments)
+            print_scenario(scenario, results['scenarios'][scenario])
+
+    output = arguments.output
+    if output is None:
+        output = BENCHMARKS_FOLDER.joinpath('results', f'benchmark_{time.strftime("%Y%m%d_%H%M%S")}.json')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(results, indent=2))
+    print(f'Results were written to {output}')
+
+    if arguments.compare is not None:
+        compare_results(json.loads(arguments.compare.read_text()), results)
+
+
+@contextlib.contextmanager
+def moto_server(port: int):
+    server = subprocess.Popen([sys.executable, '-m', 'moto.server', '-p', str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    break
+            except OSError:
+                if time.time() > deadline or server.poll() is not None:
+                    raise RuntimeError('The moto server did not start, is "moto[server]" installed?')
+                time.sleep(0.2)
+        yield
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def run_scenario_process(scenario: str, endpoint_url: str, arguments) -> dict:
+    with tempfile.TemporaryDirectory() as result_folder:
+        result_file = pathlib.Path(result_folder).joinpath('result.json')
+        command = [
+            sys.executable, __file__,
+            '--run-scenario', scenario,
+            '--endpoint-url', endpoint_url,
+            '--result-file', str(result_file),
+            '--scale', str(arguments.scale),
+            '--latency-ms', str(arguments.latency_ms),
+            f'--archive-flags={arguments.archive_flags}'
+        ]
+        subprocess.run(command, check=True)
+        return json.loads(result_file.read_text())
+
+
+def run_scenario(scenario: str, endpoint_url: str, scale: float, latency_ms: float, archive_flags: str) -> dict:
+    """
+    Runs in its own process: build the tree, then measure every command on it.
+    """
+    os.environ[constants.S3_ENDPOINT_URL_VARIABLE] = endpoint_url
+    urllib.request.urlopen(urllib.request.Request(f'{endpoint_url}/moto-api/reset', method='POST')).close()
+    aws_session = boto3.Session(aws_access_key_id='benchmark', aws_secret_access_key='benchmark', region_name=constants.AWS_REGION)
+    s3_client = commons.build_s3_client(aws_session)
+    s3_client.create_bucket(Bucket=constants.ARCHIVE_BUCKET_NAME, CreateBucketConfiguration={'LocationConstraint': constants.AWS_REGION})
+    request_counter = instrument_clients(aws_session, latency_ms)
+    archive_flag_values = commons.extract_command_flags(archive_flags)
+    # the commands ask for confirmation
+    builtins.input = lambda *_: 'Y'
+
+    with tempfile.TemporaryDirectory() as root_folder:
+        root = pathlib.Path(root_folder)
+        file_count, total_size = synthetic_trees.build_tree(scenario, root.joinpath(TREE_FOLDER), scale)
+        prefix = f'{TREE_FOLDER}/'
+        phases = {
+            'scan': lambda: commons.get_files_data(root, root.joinpath(TREE_FOLDER), keep_files=False),
+            'archive': lambda: archive_command.process_archive_command(root, aws_session, USER_ID, prefix, archive_flag_values),
+            'list': lambda: list_command.process_list_archive_command(aws_session, USER_ID, prefix, {'depth': '100'}),
+            'restore': lambda: restore_command.process_restore_command(root, aws_session, USER_ID, prefix, {}),
+            'download': lambda: download_command.process_download_command(root, aws_session, USER_ID, prefix, {}),
+        }
+        result = {'files': file_count, 'bytes': total_size, 'phases': dict()}
+        for phase, run_phase in phases.items():
+            requests_before = next(request_counter)
+            with contextlib.redirect_stdout(io.StringIO()), commons.catch_time() as phase_timer:
+                run_phase()
+            seconds = phase_timer()
+            # the counter was advanced once more by reading it
+            requests = next(request_counter) - requests_before - 1
+            result['phases'][phase] = {
+                'seconds': round(seconds, 4),
+                'files_per_second': round(file_count / seconds, 2),
+                'mb_per_second': round(total_size / (1024 * 1024) / seconds, 2),
+                'requests': requests,
+                'requests_per_second': round(requests / seconds, 2),
+                'peak_rss_mb': round(peak_rss_mb(), 2)
+            }
+        return result
+
+
+def instrument_clients(aws_session: boto3.Session, latency_ms: float) -> itertools.count:
+    """
+    Count the requests of the shared clients, and delay each of them by the latency.
+    """
+    request_counter = itertools.count()
+
+    def before_send(**kwargs):
+        next(request_counter)
+        if latency_ms > 0:
+            time.sleep(latency_ms / 1000)
+        return None
+
+    for s3_client in (commons.build_s3_client(aws_session), commons.build_s3_client_accelerated(aws_session)):
+        s3_client.meta.events.register('before-send.s3', before_send)
+    return request_counter
+
+
+def peak_rss_mb() -> float:
+    """
+    Highest resident memory of the process so far, so it grows from phase to phase.
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes on Linux, but in bytes on macOS
+    return max_rss / 1024 / 1024 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARKS_FOLDER, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_scenario(scenario: str, result: dict):
+    print(f'  {result["files"]} files, {round(result["bytes"] / (1024 * 1024), 2)} MB')
+    for phase, measurement in result['phases'].items():
+        print(f'  {phase:<10} {measurement["seconds"]:>10.3f} s {measurement["files_per_second"]:>12.1f} files/s '
+              f'{measurement["mb_per_second"]:>10.2f} MB/s {measurement["requests_per_second"]:>10.1f} req/s '
+              f'{measurement["peak_rss_mb"]:>8.1f} MB RSS')
+
+
+def compare_results(previous: dict, current: dict):
+    print(f'Comparing with the results of version {previous.get("version")} from {previous.get("timestamp")}:')
+    if previous.get('config') != current['config']:
+        print('  Warning: the runs used different settings, the comparison may be misleading.')
+    for scenario, result in current['scenarios'].items():
+        previous_result = previous['scenarios'].get(scenario)
+        if previous_result is None:
+            continue
+        for phase, measurement in result['phases'].items():
+            previous_measurement = previous_result['phases'].get(phase)
+            if previous_measurement is None or previous_measurement['seconds'] == 0:
+                continue
+            ratio = measurement['seconds'] / previous_measurement['seconds']
+            verdict = 'REGRESSION' if ratio > REGRESSION_THRESHOLD else 'ok'
+            print(f'  {scenario:<14} {phase:<10} {previous_measurement["seconds"]:>10.3f} s -> {measurement["seconds"]:>10.3f} s ({ratio:.2f}x) {verdict}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Synthetic folder trees for the benchmarks. The content is generated from a seed, so every run
+archives exactly the same data.
+"""
+import pathlib
+import random
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def build_tiny_files(root: pathlib.Path, scale: float, rng: random.Random):
+    """
+    Many small files spread over a few folders, where the per-request overhead dominates.
+    """
+    for index in range(int(5000 * scale)):
+        folder = root.joinpath(f'folder_{index % 50}')
+        folder.mkdir(parents=True, exist_ok=True)
+        folder.joinpath(f'file_{index}.txt').write_bytes(rng.randbytes(rng.randint(100, 4096)))
+
+
+def build_huge_files(root: pathlib.Path, scale: float, rng: random.Random):
+    """
+    A few large files, where the throughput of the multipart transfers dominates.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    for index in range(3):
+        with open(root.joinpath(f'huge_{index}.bin'), 'wb') as huge_file:
+            for _ in range(max(1, int(64 * scale))):
+                huge_file.write(rng.randbytes(CHUNK_SIZE))
+
+
+def build_deep_nesting(root: pathlib.Path, scale: float, rng: random.Random):
+    """
+    Deeply nested folders with a few files on every level, this stresses the scanner and the listing.
+    """
+    for branch in range(max(1, int(10 * scale))):
+        folder = root.joinpath(f'branch_{branch}')
+        for level in range(40):
+            folder = folder.joinpath(f'level_{level}')
+            folder.mkdir(parents=True, exist_ok=True)
+            for index in range(5):
+                folder.joinpath(f'file_{index}.dat').write_bytes(rng.randbytes(rng.randint(1024, 16 * 1024)))
+
+
+def build_duplicates(root: pathlib.Path, scale: float, rng: random.Random):
+    """
+    The same content stored under many names, which is what deduplication is for.
+    """
+    contents = [rng.randbytes(64 * 1024) for _ in range(50)]
+    for copy in range(max(1, int(20 * scale))):
+        folder = root.joinpath(f'copy_{copy}')
+        folder.mkdir(parents=True, exist_ok=True)
+        for index, content in enumerate(contents):
+            folder.joinpath(f'duplicate_{index}.bin').write_bytes(content)
+
+
+TREE_BUILDERS = {
+    'tiny_files': build_tiny_files,
+    'huge_files': build_huge_files,
+    'deep_nesting': build_deep_nesting,
+    'duplicates': build_duplicates,
+}
+
+
+def build_tree(name: str, root: pathlib.Path, scale: float, seed: int = 42) -> tuple[int, int]:
+    """
+    Create the named tree under the root.
+    :return: Count and total size of the created files.
+    """
+    TREE_BUILDERS[name](root, scale, random.Random(seed))
+    files = [path for path in root.rglob('*') if path.is_file()]
+    return len(files), sum(path.stat().st_size for path in files)
@@ -10,6 +10,19 @@ resource "aws_s3_bucket_versioning" "archival_versioning" {
   }
 }
 
+// uploads that the application could not abort (for example it was killed) stop being charged after a week
+resource "aws_s3_bucket_lifecycle_configuration" "archival_lifecycle" {
+  bucket = aws_s3_bucket.archive_storage_bucket.id
+  rule {
+    id = "AbortIncompleteMultipartUploads"
+    status = "Enabled"
+    filter {}
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 7
+    }
+  }
+}
+
 resource "aws_s3_bucket_accelerate_configuration" "archival_accelerate" {
   bucket = aws_s3_bucket.archive_storage_bucket.id
   status = "Enabled" //or "Suspended"
@@ -110,7 +110,7 @@ data "aws_iam_policy_document" "cognito_user_policy" {
   statement {
     sid = "ManageOwnObjects"
     effect = "Allow"
-    actions = ["s3:GetObject", "s3:PutObject", "s3:RestoreObject"]
+    actions = ["s3:GetObject", "s3:PutObject", "s3:RestoreObject", "s3:AbortMultipartUpload", "s3:ListMultipartUploadParts"]
     resources = ["${var.archive_data_bucket_arn}/&{cognito-identity.amazonaws.com:sub}/*"]
   }
   statement {